@@ -23,12 +23,15 @@
 from __future__ import with_statement
 from email.mime.text import MIMEText
 import glob
+import json
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import os
 import pwd
 import re
 import shutil
 import socket
+import stat
 try:
     import sqlite3
 except ImportError:
@@ -37,6 +40,7 @@ except ImportError:
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import eups
@@ -51,9 +55,533 @@ def _checkWritable(path):
     if not os.access(path, os.W_OK):
         raise RuntimeError("Required path " + path + " is unwritable")
 
+def getButler(root):
+    """Return a butler for the input repository at root, with its registry
+    read into an in-memory copy so that the many queries made while
+    listing a large input do not each go back to the file."""
+    import lsst.daf.persistence as dafPersist
+    from lsst.obs.sdss import SdssMapper
+    mapper = SdssMapper(root=root)
+    registry = getattr(mapper, "registry", None)
+    conn = getattr(registry, "conn", None)
+    if conn is not None:
+        memory = sqlite3.connect(":memory:")
+        memory.executescript("\n".join(conn.iterdump()))
+        conn.close()
+        registry.conn = memory
+    return dafPersist.ButlerFactory(mapper=mapper).create()
+
+def _writeJson(path, value):
+    """Atomically replace path with the JSON form of value"""
+    tempFileDescriptor, tempFilename = tempfile.mkstemp(
+            dir=os.path.dirname(path))
+    try:
+        with os.fdopen(tempFileDescriptor, "w") as tempFile:
+            json.dump(value, tempFile)
+        os.chmod(tempFilename, 0644)
+        os.rename(tempFilename, path)
+    except:
+        os.unlink(tempFilename)
+        raise
+
+def _datasetPath(butler, datasetType, dataId):
+    """Return the path of the file holding a dataset, without any HDU
+    suffix"""
+    path = butler.mapper.map(datasetType, dataId).getLocations()[0]
+    path = re.sub(r'\[.*\]$', "", path)
+    return os.path.normpath(os.path.join(butler.mapper.root, path))
+
+def _listDirectory(path):
+    files = []
+    subdirs = []
+    for name in os.listdir(path):
+        fullPath = os.path.join(path, name)
+        try:
+            st = os.stat(fullPath)
+        except OSError:
+            # A dangling symlink or a file removed since the listing; like
+            # datasetExists, count it as missing
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append(fullPath)
+        else:
+            files.append((fullPath, st.st_size))
+    return files, subdirs
+
+def _scanTree(root, nThreads=16):
+    """Return a dict mapping the path of every file below root to its size.
+
+    Each level of the tree is listed in parallel, so the metadata
+    round-trips to the file server overlap instead of being made one at a
+    time.
+    """
+    present = dict()
+    pool = ThreadPool(nThreads)
+    try:
+        level = [os.path.normpath(root)]
+        while level:
+            nextLevel = []
+            for files, subdirs in pool.map(_listDirectory, level):
+                present.update(files)
+                nextLevel.extend(subdirs)
+            level = nextLevel
+    finally:
+        pool.close()
+        pool.join()
+    return present
+
+def _fqdn(machine):
+    if machine.find(".") == -1:
+        machine = machine + "." + RunConfiguration.defaultDomain
+    return machine
+
+def _sshAll(hosts, command, timeout=10):
+    """Run a command on each of a list of hosts concurrently over ssh.
+    command may also be a dict mapping each host to its own command.
+
+    Returns a dict mapping each host to (return code, standard output,
+    elapsed seconds).  The return code is None for a host that did not
+    finish within timeout seconds; its ssh is killed.
+    """
+    start = time.time()
+    procs = dict()
+    for host in hosts:
+        if isinstance(command, dict):
+            hostCommand = command[host]
+        else:
+            hostCommand = command
+        procs[host] = subprocess.Popen(["ssh", "-n",
+            "-o", "BatchMode=yes", "-o", "ConnectTimeout=%d" % (timeout,),
+            host, hostCommand],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    results = dict()
+    while len(results) < len(procs):
+        for host, proc in procs.iteritems():
+            if results.has_key(host):
+                continue
+            if proc.poll() is not None:
+                results[host] = (proc.returncode, proc.stdout.read(),
+                        time.time() - start)
+            elif time.time() - start > timeout:
+                proc.kill()
+                proc.wait()
+                results[host] = (None, "", time.time() - start)
+        time.sleep(0.05)
+    return results
+
+def _ancestors():
+    """Return the ids of this process and all of its ancestors"""
+    pids = set()
+    pid = os.getpid()
+    while pid > 1 and pid not in pids:
+        pids.add(pid)
+        ps = subprocess.Popen(["ps", "-o", "ppid=", "-p", str(pid)],
+                stdout=subprocess.PIPE)
+        ppid = ps.communicate()[0].strip()
+        pid = int(ppid) if ppid.isdigit() else 0
+    return pids
+
+def _probeCapacity(machines, timeout=10):
+    """Return a dict mapping each machine to (cores, free memory in bytes,
+    1-minute load average, ssh round-trip seconds), or to None if it could
+    not be probed."""
+    command = "grep -c ^processor /proc/cpuinfo; " \
+            "awk '/^(MemFree|Buffers|Cached):/ {s += $2} END {print s}' " \
+            "/proc/meminfo; cat /proc/loadavg"
+    hosts = dict([(_fqdn(machine), machine) for machine in machines])
+    capacity = dict()
+    for host, (returncode, output, elapsed) in \
+            _sshAll(hosts.keys(), command, timeout).iteritems():
+        capacity[hosts[host]] = None
+        if returncode != 0:
+            continue
+        try:
+            lines = output.split("\n")
+            capacity[hosts[host]] = (int(lines[0]), int(lines[1]) * 1024,
+                    float(lines[2].split()[0]), elapsed)
+        except (ValueError, IndexError):
+            pass
+    return capacity
+
 class NoMatchError(RuntimeError):
     pass
 
+class OrcaMonitor(threading.Thread):
+    """Watch a production while orca runs.
+
+    Every interval seconds the monitor reads whatever has been appended to
+    unifiedPipeline.log and the workers' launch.log files, alerting on
+    MemoryError and bad_alloc as soon as they appear.  It flags workers
+    whose launch.log has not grown for stallInterval seconds, and counts
+    the CCDs with results in the output tree to estimate throughput and
+    the time remaining.
+    """
+
+    alertRegex = re.compile(r"MemoryError|bad_alloc")
+
+    def __init__(self, configuration, resultGlobs, ccdCount,
+            interval, stallInterval, reportInterval=600):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.configuration = configuration
+        self.outputDirectory = configuration.outputDirectory
+        self.resultGlobs = resultGlobs
+        self.ccdCount = ccdCount
+        self.interval = interval
+        self.stallInterval = stallInterval
+        self.reportInterval = reportInterval
+        self.finished = threading.Event()
+        self.offsets = dict()
+        self.lastGrowth = dict()
+        self.stalled = set()
+        self.startTime = time.time()
+        self.lastReport = self.startTime
+        self.completed = 0
+        self.status = "No CCDs complete"
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+    def run(self):
+        while not self.finished.isSet():
+            try:
+                self.check()
+            except Exception, e:
+                print >>sys.stderr, "Warning: orca monitor failed:", e
+            self.finished.wait(self.interval)
+
+    def _readNew(self, path):
+        """Return the text appended to a file since the last call"""
+        size = os.path.getsize(path)
+        offset = self.offsets.get(path, 0)
+        if size < offset:
+            # Truncated or replaced; start again
+            offset = 0
+        if size == offset:
+            return ""
+        with open(path, "r") as f:
+            f.seek(offset)
+            text = f.read(size - offset)
+        self.offsets[path] = offset + len(text)
+        return text
+
+    def check(self):
+        now = time.time()
+        workerLogs = glob.glob(os.path.join(self.outputDirectory,
+            "work", "*", "launch.log"))
+        logs = [os.path.join(self.outputDirectory, "run",
+            "unifiedPipeline.log")] + workerLogs
+        for path in logs:
+            if not os.path.exists(path):
+                continue
+            text = self._readNew(path)
+            if text != "" or not self.lastGrowth.has_key(path):
+                self.lastGrowth[path] = now
+            if text != "" and path in self.stalled:
+                self.stalled.remove(path)
+                self.configuration._log("Worker resumed: " + path)
+            alerts = [line for line in text.split("\n")
+                    if self.alertRegex.search(line)]
+            if len(alerts) > 0:
+                self.configuration._log("*** Memory failure in " + path)
+                self.configuration._sendmail("Memory failure",
+                        path + ":\n" + "\n".join(alerts))
+
+        for path in workerLogs:
+            if path not in self.stalled and \
+                    now - self.lastGrowth[path] > self.stallInterval:
+                self.stalled.add(path)
+                self.configuration._log("*** Worker stalled for %d sec: %s" %
+                        (now - self.lastGrowth[path], path))
+                self.configuration._sendmail("Worker stalled",
+                        "No output to %s for %d sec" %
+                        (path, now - self.lastGrowth[path]))
+
+        # A CCD is complete once all of its result files exist
+        completed = min([len(glob.glob(os.path.join(self.outputDirectory,
+            pattern))) for pattern in self.resultGlobs])
+        hours = (now - self.startTime) / 3600.0
+        if completed > 0 and hours > 0:
+            rate = completed / hours
+            remaining = max(self.ccdCount - completed, 0) / rate
+            self.status = "%d of %d CCDs complete, %.1f CCDs/hour, " \
+                    "ETA %s" % (completed, self.ccdCount, rate,
+                            time.ctime(now + remaining * 3600))
+        if completed != self.completed and \
+                now - self.lastReport >= self.reportInterval:
+            self.configuration._log(self.status)
+            self.lastReport = now
+        self.completed = completed
+
+def _likeRegex(*patterns):
+    """Compile SQL LIKE patterns into one regex that, used with search(),
+    matches what any of them would under MySQL's default case-insensitive
+    collation"""
+    alternatives = []
+    for pattern in patterns:
+        regex = ""
+        if not pattern.startswith("%"):
+            regex += "^"
+        for c in pattern.strip("%"):
+            if c == "%":
+                regex += ".*"
+            elif c == "_":
+                regex += "."
+            else:
+                regex += re.escape(c)
+        if not pattern.endswith("%"):
+            regex += r"\Z"
+        alternatives.append(regex)
+    return re.compile("|".join(alternatives), re.I | re.S)
+
+class LogAnalysis(object):
+    """Summary of an orca Logs table built from one pass over its rows.
+
+    Rows must be passed to consume() in id order.  Each is classified once
+    as a job start, shutdown, output write or error, and format() renders
+    the counts and error excerpts for analyzeLogs.  getState() and
+    setState() convert the analysis to and from a JSON-compatible dict so
+    that it can be resumed from the row after lastId; the excerpts, which
+    grow with the number of errors, are kept out of that dict and saved
+    separately (see _saveLogAnalysis).
+    """
+
+    jobStartRegex = re.compile(
+        r"Processing job:"
+        r"(\s+filter=(?P<filter>\w)"
+        r"|\s+field=(?P<field>\d+)"
+        r"|\s+camcol=(?P<camcol>\d)"
+        r"|\s+run=(?P<run>\d+)"
+        r"|\s+type=calexp){5}"
+    )
+    descriptions = [(1, 'pipeline shutdowns seen'), (2, 'CCDs attempted'),
+            (3, 'src writes'), (4, 'calexp writes')]
+
+    jobLike = _likeRegex('Processing job:%')
+    shutdownLike = _likeRegex('Processing job:% filter=0%')
+    notShutdownLike = _likeRegex('% filter=0%')
+    srcWriteLike = _likeRegex('Ending write to BoostStorage%/src%')
+    calexpWriteLike = _likeRegex('Ending write to FitsStorage%/calexp%')
+    # The failure count only takes whole-message "fail"s, while the
+    # listing takes any containing "fail"
+    failureLike = _likeRegex('%rror%', '%xception%', '%arning%',
+            'Fail', 'fail')
+    errorLike = _likeRegex('%rror%', '%xception%', '%arning%',
+            '%Fail%', '%fail%')
+    excludedLike = _likeRegex('%failureStage%', '%failure stage%',
+            'failSerialName%', 'failParallelName%',
+            'Distortion fitter failed to improve%',
+            '%magnitude error column%', '%errorFlagged%',
+            'Skipping process due to error')
+    pipelineSampleSize = 10000
+
+    def __init__(self):
+        self.lastId = 0
+        self.first = None
+        self.last = None
+        self.rowCount = 0
+        self.sampleWorkers = set()
+        self.counts = dict()
+        self.failures = 0
+        self.lastMessages = dict()
+        self.jobs = dict()
+        self.jobStarts = dict()
+        self.durations = dict()
+        self.excerpts = []
+        # Excerpts already in the excerpt file, and its length in bytes
+        self.savedExcerpts = 0
+        self.excerptBytes = 0
+
+    def consume(self, d):
+        comment = d['COMMENT']
+        worker = d['workerid']
+        self.lastId = d['id']
+        if self.first is None:
+            self.first = (long(d['TIMESTAMP']), str(d['timereceived']))
+        self.last = (long(d['TIMESTAMP']), str(d['timereceived']))
+        if self.rowCount < LogAnalysis.pipelineSampleSize and \
+                worker is not None:
+            self.sampleWorkers.add(worker)
+        self.rowCount += 1
+        self.lastMessages[worker] = (d['id'], comment)
+        if comment is None:
+            return
+
+        isJob = LogAnalysis.jobLike.search(comment) is not None
+        if isJob and LogAnalysis.shutdownLike.search(comment):
+            gid = 1
+        elif isJob and not LogAnalysis.notShutdownLike.search(comment):
+            gid = 2
+        elif LogAnalysis.srcWriteLike.search(comment):
+            gid = 3
+        elif LogAnalysis.calexpWriteLike.search(comment):
+            gid = 4
+        else:
+            gid = 0
+        if gid > 0:
+            self.counts[gid] = self.counts.get(gid, 0) + 1
+
+        excluded = LogAnalysis.excludedLike.search(comment) is not None
+        if not excluded and LogAnalysis.failureLike.search(comment):
+            self.failures += 1
+        if not isJob and (excluded or
+                not LogAnalysis.errorLike.search(comment)):
+            return
+
+        # A worker's next job (or shutdown) ends its previous one
+        if comment.startswith('Processing job:') and \
+                self.jobStarts.has_key(worker):
+            id, start = self.jobStarts.pop(worker)
+            self.durations[id] = (long(d['TIMESTAMP']) - start) / 1.0e9
+        match = LogAnalysis.jobStartRegex.search(comment)
+        if match:
+            id = RunConfiguration.ccdIdPattern % dict(
+                    run=int(match.group("run")),
+                    filter=match.group("filter"),
+                    camcol=int(match.group("camcol")),
+                    field=int(match.group("field")))
+            self.jobStarts[worker] = (id, long(d['TIMESTAMP']))
+            self.jobs[worker] = "Band %s Run %s Camcol %s Frame %s" % (
+                    match.group("filter"), match.group("run"),
+                    match.group("camcol"), match.group("field"))
+        elif not comment.startswith('Processing job:'):
+            if self.jobs.has_key(worker):
+                job = self.jobs[worker]
+            else:
+                job = "unknown"
+            excerpt = "\n*** Error in %s in stage %s on %s:\n" % (
+                        job, d['stagename'], worker)
+            lines = comment.split('\n')
+            i = len(lines) - 1
+            message = lines[i].strip()
+            # Skip blank lines at end
+            while i > 0 and message == "":
+                i -= 1
+                message = lines[i].strip()
+            # Go back until we find a traceback line with " in "
+            while i > 0 and lines[i].find(" in ") == -1:
+                i -= 1
+                message = lines[i].strip() + "\n" + message
+            self.excerpts.append(excerpt + message + "\n")
+
+    def getState(self):
+        return dict(
+                lastId=self.lastId,
+                first=self.first,
+                last=self.last,
+                rowCount=self.rowCount,
+                sampleWorkers=list(self.sampleWorkers),
+                counts=self.counts.items(),
+                failures=self.failures,
+                lastMessages=[(worker, id, msg) for worker, (id, msg) in
+                    self.lastMessages.iteritems()],
+                jobs=self.jobs.items(),
+                jobStarts=[(worker, id, start) for worker, (id, start) in
+                    self.jobStarts.iteritems()],
+                durations=self.durations)
+
+    def setState(self, state, excerpts):
+        self.lastId = state["lastId"]
+        self.first = state["first"]
+        self.last = state["last"]
+        self.rowCount = state["rowCount"]
+        self.sampleWorkers = set(state["sampleWorkers"])
+        self.counts = dict(state["counts"])
+        self.failures = state["failures"]
+        self.lastMessages = dict([(worker, (id, msg))
+            for worker, id, msg in state["lastMessages"]])
+        self.jobs = dict(state["jobs"])
+        self.jobStarts = dict([(worker, (id, start))
+            for worker, id, start in state["jobStarts"]])
+        self.durations = state["durations"]
+        self.excerpts = list(excerpts)
+
+    def format(self, inProgress=False):
+        if self.first is None:
+            if inProgress:
+                return "No log entries yet\n"
+            else:
+                return "*** No log entries written\n"
+        startTime, start = self.first
+        stopTime, stop = self.last
+        result = "First orca log entry: %s\n" % (start,)
+        result += "Last orca log entry: %s\n" % (stop,)
+        elapsed = stopTime - startTime
+        elapsedHr = elapsed / 3600 / 1000 / 1000 / 1000
+        elapsed -= elapsedHr * 3600 * 1000 * 1000 * 1000
+        elapsedMin = elapsed / 60 / 1000 / 1000 / 1000
+        elapsed -= elapsedMin * 60 * 1000 * 1000 * 1000
+        elapsedSec = elapsed / 1.0e9
+        result += "Orca elapsed time: %d:%02d:%06.3f\n" % (elapsedHr,
+                elapsedMin, elapsedSec)
+
+        nPipelines = len(self.sampleWorkers)
+        result += "%d pipelines used\n" % (nPipelines,)
+        for gid, descr in LogAnalysis.descriptions:
+            if self.counts.get(gid, 0) > 0:
+                result += "%d %s\n" % (self.counts[gid], descr)
+        nShutdown = self.counts.get(1, 0)
+        if nShutdown != nPipelines:
+            if not inProgress:
+                if nShutdown == 0:
+                    result += "\n*** No pipelines were shut down properly\n"
+                else:
+                    result += "\n*** Shutdowns do not match pipelines\n"
+            lastMessages = sorted(self.lastMessages.iteritems(),
+                    key=lambda (worker, (id, msg)): id)
+            for worker, (id, msg) in lastMessages:
+                if inProgress:
+                    result += "Pipeline %s last status: %s\n" % (worker, msg)
+                else:
+                    result += "Pipeline %s ended with: %s\n" % (worker, msg)
+
+        result += "%d failures seen\n" % (self.failures,)
+        result += "".join(self.excerpts)
+        return result
+
+def _loadLogAnalysis(statePath, excerptPath, database):
+    """Return the LogAnalysis of a database saved by _saveLogAnalysis, or a
+    new one if there is no usable saved analysis"""
+    try:
+        with open(statePath, "r") as f:
+            state = json.load(f)
+        if state["database"] != database:
+            return LogAnalysis()
+        with open(excerptPath, "r") as f:
+            text = f.read(state["excerptBytes"])
+        if len(text) != state["excerptBytes"]:
+            return LogAnalysis()
+        analysis = LogAnalysis()
+        analysis.setState(state,
+                [json.loads(line) for line in text.splitlines()])
+    except (IOError, ValueError, KeyError, TypeError):
+        return LogAnalysis()
+    analysis.savedExcerpts = len(analysis.excerpts)
+    analysis.excerptBytes = state["excerptBytes"]
+    return analysis
+
+def _saveLogAnalysis(analysis, statePath, excerptPath, database):
+    """Save a LogAnalysis of a database for _loadLogAnalysis.
+
+    Only the excerpts added since the analysis was loaded are written,
+    appended one JSON string per line to excerptPath, so that the cost of a
+    save does not grow with the errors already seen.  The state records
+    the length of the excerpt file it goes with; anything beyond that,
+    appended by a save whose state was never written, is cut off first.
+    """
+    with open(excerptPath, "a") as f:
+        f.truncate(analysis.excerptBytes)
+        for excerpt in analysis.excerpts[analysis.savedExcerpts:]:
+            f.write(json.dumps(excerpt) + "\n")
+        f.flush()
+        excerptBytes = os.fstat(f.fileno()).st_size
+    state = analysis.getState()
+    state.update(database=database, excerptBytes=excerptBytes)
+    _writeJson(statePath, state)
+    analysis.savedExcerpts = len(analysis.excerpts)
+    analysis.excerptBytes = excerptBytes
+
 class RunConfiguration(object):
 
     ###########################################################################
@@ -79,10 +607,30 @@ class RunConfiguration(object):
             'rh6-3': ['lsst11:2', 'lsst14:2', 'lsst15:2']
     }
 
+    # Seconds to wait for processes to exit after shutprod and after each
+    # signal when killing a run
+    shutdownWait = 15
+    killWait = 5
+
+    # Seconds between checks of a running production, and without log
+    # output before a worker is reported as stalled
+    monitorInterval = 60
+    stallInterval = 1800
+    # Output files that together mark a CCD as processed
+    resultGlobs = [os.path.join("output", "sci-results", "*", "*", "*",
+        "src", "src-*.fits")]
+
+    # Memory needed by each pipeline process, used to judge host capacity
+    memoryPerProcess = int(2e9)
+
     # These should generally be left unchanged
     runIdPattern = "%(runType)s_%(datetime)s"
     lockBase = os.path.join(outputBase, "locks")
     collection = "S12_sdss"
+    # Registry keys identifying a CCD and their form in the ccdlist
+    ccdKeys = ("run", "filter", "camcol", "field")
+    ccdIdPattern = "run=%(run)d filter=%(filter)s camcol=%(camcol)d field=%(field)d"
+    calibrationTypes = ()
     spacePerCcd = int(31e6) # calexp only
     version = 2
     sendmail = None
@@ -91,12 +639,14 @@ class RunConfiguration(object):
         if os.access(cmd, os.X_OK):
             sendmail = cmd
             break
-    if sendmail is None:
-        raise RuntimeError("Unable to find sendmail executable")
 
     ###########################################################################
 
     def __init__(self, args):
+        # Checked here rather than at import so that tests can load the
+        # module on hosts without sendmail
+        if RunConfiguration.sendmail is None:
+            raise RuntimeError("Unable to find sendmail executable")
         self.datetime = time.strftime("%Y_%m%d_%H%M%S")
         self.user = pwd.getpwuid(os.getuid())[0]
         if self.user == 'buildbot':
@@ -194,11 +744,21 @@ class RunConfiguration(object):
         for machineSet in RunConfiguration.machineSets.itervalues():
             for machine in machineSet:
                 machine = re.sub(r':.*', "", machine)
-                machines.update([machine])
-        for machine in machines:
-            if machine.find(".") == -1:
-                machine = machine + "." + RunConfiguration.defaultDomain
-            subprocess.check_call(["ssh", machine, "/bin/true"])
+                machines.add(machine)
+        capacity = _probeCapacity(machines)
+        print "%-32s %-9s %8s %5s %5s" % ("Host", "Reachable", "Latency",
+                "Cores", "Load")
+        unreachable = []
+        for machine in sorted(machines):
+            if capacity[machine] is None:
+                unreachable.append(machine)
+                print "%-32s %-9s" % (_fqdn(machine), "no")
+            else:
+                cores, freeMemory, load, latency = capacity[machine]
+                print "%-32s %-9s %7.2fs %5d %5.2f" % (_fqdn(machine), "yes",
+                        latency, cores, load)
+        if len(unreachable) > 0:
+            raise RuntimeError("Unreachable hosts: " + ", ".join(unreachable))
 
     def printStatus(self):
         machineSets = RunConfiguration.machineSets.keys()
@@ -247,7 +807,12 @@ class RunConfiguration(object):
 
     def listInputs(self):
         for path in sorted(os.listdir(RunConfiguration.inputBase)):
-            if os.path.exists(os.path.join(RunConfiguration.inputBase, path,
+            manifest = self.readManifest(path)
+            if manifest is not None:
+                print "%s\t%d frames, %.1f GB fpC" % (path,
+                        len(manifest["ccds"]),
+                        sum(manifest["sizes"].itervalues()) / 1e9)
+            elif os.path.exists(os.path.join(RunConfiguration.inputBase, path,
                 RunConfiguration.collection)):
                 print path
 
@@ -279,11 +844,7 @@ class RunConfiguration(object):
         _checkReadable(self.registryPath)
 
         if self.options.ccdCount is None:
-            conn = sqlite3.connect(self.registryPath)
-            self.options.ccdCount = conn.execute(
-                    """SELECT COUNT(
-                    DISTINCT run||':'||filter||':'||camcol||':'||field)
-                    FROM raw;""").fetchone()[0]
+            self.options.ccdCount = self.inputManifest()["ccdCount"]
         if self.options.ccdCount < 2:
             raise RuntimeError("Must process at least two CCDs")
 
@@ -299,6 +860,158 @@ class RunConfiguration(object):
                     "%d available, %d needed" %
                     (availableSpace, minimumSpace))
 
+    def registrySummary(self, registryPath):
+        """Return the number of distinct CCDs in the raw table of a registry
+        and the number of raw entries (channels) of each CCD.
+
+        The summary is kept as JSON beside the registry and recomputed
+        whenever the registry is modified.
+        """
+        summaryPath = registryPath + ".summary"
+        mtime = os.stat(registryPath).st_mtime
+        try:
+            with open(summaryPath, "r") as f:
+                summary = json.load(f)
+            if summary["mtime"] == mtime:
+                return summary
+        except (IOError, ValueError, KeyError):
+            pass
+
+        keys = ", ".join(RunConfiguration.ccdKeys)
+        conn = sqlite3.connect(registryPath)
+        try:
+            rows = conn.execute("SELECT " + keys + ", COUNT(*) FROM raw"
+                    " GROUP BY " + keys).fetchall()
+        finally:
+            conn.close()
+        channelCounts = dict()
+        for row in rows:
+            dataId = dict(zip(RunConfiguration.ccdKeys, row[:-1]))
+            channelCounts[RunConfiguration.ccdIdPattern % dataId] = row[-1]
+        summary = dict(mtime=mtime, ccdCount=len(channelCounts),
+                channelCounts=channelCounts)
+
+        # The input area may well be read-only; the summary is then simply
+        # recomputed next time
+        try:
+            _writeJson(summaryPath, summary)
+        except (IOError, OSError):
+            pass
+        return summary
+
+    def _manifestPath(self, input):
+        return os.path.join(RunConfiguration.outputBase, "manifests",
+                input + ".json")
+
+    def _manifestKey(self, inputDirectory):
+        """Return the modification times of an input directory and of its
+        top-level entries, which change whenever the input is altered"""
+        key = {inputDirectory: os.stat(inputDirectory).st_mtime}
+        for entry in os.listdir(inputDirectory):
+            path = os.path.join(inputDirectory, entry)
+            key[path] = os.stat(path).st_mtime
+        return key
+
+    def readManifest(self, input):
+        """Return the manifest of an input, or None if it has not been
+        built or is out of date."""
+        try:
+            with open(self._manifestPath(input), "r") as f:
+                manifest = json.load(f)
+            inputDirectory = os.path.join(RunConfiguration.inputBase, input,
+                    RunConfiguration.collection)
+            if manifest["key"] == self._manifestKey(inputDirectory):
+                return manifest
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def inputManifest(self):
+        """Return the manifest of the selected input, building it if needed.
+
+        The manifest lists every frame in the registry in butler order along
+        with its number of registry entries and the size of its fpC file,
+        and the number of files of each calibration type.  It is kept under
+        outputBase so that later launches need not walk the input tree.
+        """
+        manifest = self.readManifest(self.options.input)
+        if manifest is not None:
+            return manifest
+
+        key = self._manifestKey(self.inputDirectory)
+        butler = getButler(self.inputDirectory)
+        files = _scanTree(self.inputDirectory)
+        ccds = []
+        channelCounts = dict()
+        sizes = dict()
+        summary = self.registrySummary(self.registryPath)
+        for frameRef in butler.subset("fpC", "filter"):
+            id = RunConfiguration.ccdIdPattern % frameRef.dataId
+            path = _datasetPath(butler, "fpC", frameRef.dataId)
+            ccds.append(id)
+            channelCounts[id] = summary["channelCounts"].get(id, 0)
+            sizes[id] = files.get(path, 0)
+        calibrations = dict()
+        for calibration in RunConfiguration.calibrationTypes:
+            prefix = os.path.join(self.inputDirectory, calibration) + os.sep
+            calibrations[calibration] = \
+                    len([path for path in files if path.startswith(prefix)])
+        manifest = dict(key=key,
+                ccdCount=summary["ccdCount"],
+                ccds=ccds, channelCounts=channelCounts, sizes=sizes,
+                calibrations=calibrations)
+
+        manifestPath = self._manifestPath(self.options.input)
+        try:
+            if not os.path.exists(os.path.dirname(manifestPath)):
+                os.makedirs(os.path.dirname(manifestPath))
+            _writeJson(manifestPath, manifest)
+        except (IOError, OSError), e:
+            print >>sys.stderr, "Warning: unable to save input manifest:", e
+        return manifest
+
+    def _costModelPath(self):
+        return os.path.join(RunConfiguration.outputBase, "ccdCosts.json")
+
+    def readCostModel(self):
+        """Return the last measured processing time in seconds of each CCD"""
+        try:
+            with open(self._costModelPath(), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def updateCostModel(self, durations):
+        model = self.readCostModel()
+        model.update(durations)
+        try:
+            _writeJson(self._costModelPath(), model)
+        except (IOError, OSError):
+            pass
+
+    def expectedCosts(self, manifest):
+        """Return the expected processing time of each CCD of an input.
+
+        CCDs that have not been timed are estimated from their raw size at
+        the median seconds per byte of those that have; with no timings at
+        all the raw size alone orders them.
+        """
+        model = self.readCostModel()
+        sizes = manifest["sizes"]
+        ratios = sorted([model[id] / sizes[id] for id in manifest["ccds"]
+            if model.has_key(id) and sizes[id] > 0])
+        if len(ratios) > 0:
+            secondsPerByte = ratios[len(ratios) / 2]
+        else:
+            secondsPerByte = 1.0
+        costs = dict()
+        for id in manifest["ccds"]:
+            if model.has_key(id):
+                costs[id] = model[id]
+            else:
+                costs[id] = sizes[id] * secondsPerByte
+        return costs
+
     def run(self):
         self.runInfo = """Version: %d
 Run: %s
@@ -563,18 +1276,14 @@ workflow: {
     def generateInputList(self):
         with open("ccdlist", "w") as inputFile:
             print >>inputFile, ">intids run camcol field"
-            import lsst.daf.persistence as dafPersist
-            from lsst.obs.sdss import SdssMapper
-            butler = dafPersist.ButlerFactory(
-                    mapper=SdssMapper(root=self.inputDirectory)).create()
-            numInputs = 0
-            for frameRef in butler.subset("fpC", "filter"):
-                print >>inputFile, "raw", \
-                        "run=%(run)d filter=%(filter)s camcol=%(camcol)d field=%(field)d" % \
-                        frameRef.dataId
-                numInputs += 1
-                if numInputs >= self.options.ccdCount:
-                    break
+            manifest = self.inputManifest()
+            selected = manifest["ccds"][:self.options.ccdCount]
+            # The job office hands out frames in list order; starting the
+            # most expensive first keeps stragglers from extending the run
+            costs = self.expectedCosts(manifest)
+            selected.sort(key=lambda id: costs[id], reverse=True)
+            for id in selected:
+                print >>inputFile, "raw", id
             for i in xrange(self.nPipelines):
                 print >>inputFile, "raw run=0 filter=0 camcol=0 field=0"
 
@@ -611,13 +1320,59 @@ workflow: {
         os.unlink(tempFilename)
         return True
 
+    def _predictedPipelines(self, machineSet, capacity):
+        """Return the number of pipelines a machine set can be expected to
+        keep busy given its hosts' free cores and memory, or None if any of
+        its hosts could not be probed."""
+        total = 0.0
+        for machine in RunConfiguration.machineSets[machineSet]:
+            machineName, processes = machine.split(':')
+            if capacity.get(machineName) is None:
+                return None
+            cores, freeMemory, load, latency = capacity[machineName]
+            total += min(float(processes), max(cores - load, 0.0),
+                    freeMemory / float(RunConfiguration.memoryPerProcess))
+        return total
+
     def lockMachines(self):
-        machineSets = sorted(RunConfiguration.machineSets.keys())
-        for machineSet in machineSets:
-            if machineSet.startswith(self.arch):
-                if self._lockSet(machineSet):
-                    self.machineSet = machineSet
-                    return
+        candidates = [machineSet for machineSet in
+                sorted(RunConfiguration.machineSets.keys())
+                if machineSet.startswith(self.arch) and
+                not os.path.exists(self._lockName(machineSet))]
+        machines = set()
+        for machineSet in candidates:
+            for machine in RunConfiguration.machineSets[machineSet]:
+                machines.add(re.sub(r':.*', "", machine))
+        capacity = _probeCapacity(machines)
+
+        # More pipelines than CCDs gain nothing, so among sets that can
+        # keep every CCD busy prefer the smallest; sets with unreachable
+        # hosts are tried last
+        scores = dict()
+        for machineSet in candidates:
+            scores[machineSet] = self._predictedPipelines(machineSet,
+                    capacity)
+        def preference(machineSet):
+            if scores[machineSet] is None:
+                return (1, 0, 0)
+            processes = sum([int(re.sub(r'.*:', "", machine)) for machine in
+                RunConfiguration.machineSets[machineSet]])
+            return (0, -min(scores[machineSet], self.options.ccdCount),
+                    processes)
+        candidates.sort(key=preference)
+
+        runInfo = self.runInfo
+        for machineSet in candidates:
+            if scores[machineSet] is None:
+                choice = "hosts unreachable"
+            else:
+                choice = "%.1f pipelines predicted" % (scores[machineSet],)
+            self.runInfo = runInfo + "Machine set: %s (%s)\n" % (machineSet,
+                    choice)
+            if self._lockSet(machineSet):
+                self.machineSet = machineSet
+                return
+        self.runInfo = runInfo
         raise RuntimeError("Unable to acquire a machine set for arch %s" %
                 (self.arch,))
 
@@ -654,15 +1409,21 @@ workflow: {
             raise
 
     def doOrcaRun(self):
+        monitor = OrcaMonitor(self, RunConfiguration.resultGlobs,
+                self.options.ccdCount, RunConfiguration.monitorInterval,
+                RunConfiguration.stallInterval)
         try:
-            subprocess.check_call("$CTRL_ORCA_DIR/bin/orca.py"
-                    " -e env.sh"
-                    " -r ."
-                    " -V 30 -L 2 orca.paf " + self.runId + 
-                    " >& unifiedPipeline.log",
-                    shell=True, stdin=open("/dev/null", "r"))
-            # TODO -- monitor orca run, looking for output changes/stalls
-            # TODO -- look for MemoryErrors and bad_allocs in logs
+            with open("unifiedPipeline.log", "w") as log:
+                orca = subprocess.Popen("$CTRL_ORCA_DIR/bin/orca.py"
+                        " -e env.sh"
+                        " -r ."
+                        " -V 30 -L 2 orca.paf " + self.runId,
+                        shell=True, stdin=open("/dev/null", "r"),
+                        stdout=log, stderr=subprocess.STDOUT)
+            monitor.start()
+            returnCode = orca.wait()
+            if returnCode != 0:
+                raise subprocess.CalledProcessError(returnCode, "orca.py")
         except subprocess.CalledProcessError:
             self._log("*** Orca failed")
             print >>sys.stderr, self.orcaStatus(self.runId,
@@ -672,6 +1433,10 @@ workflow: {
             self._log("*** Orca interrupted")
             self.kill(self.runId)
             raise
+        finally:
+            if monitor.isAlive():
+                monitor.stop()
+                self._log(monitor.status)
 
     def setupCheck(self):
         tags = os.path.join(self.outputDirectory, "config", "weekly.tags")
@@ -816,25 +1581,65 @@ workflow: {
         self._log("*** orca killed")
         subprocess.check_call("$CTRL_ORCA_DIR/bin/shutprod.py 1 " + runId,
                 shell=True)
+        hosts = [_fqdn(re.sub(r':.*', "", machine)) for machine in
+                RunConfiguration.machineSets[self.machineSet]]
+        # Bracketing the first character keeps the pattern from matching
+        # the remote shell running it
+        pattern = "[%s]%s" % (runId[0], runId[1:])
+        # This process and its parents also mention the runId when killing
+        # from a host in the set
+        exclude = dict()
+        for host in hosts:
+            if host.split(".")[0] == self.hostname.split(".")[0]:
+                exclude[host] = _ancestors()
         print >>sys.stderr, "waiting for production shutdown"
-        time.sleep(15)
-        print >>sys.stderr, "killing all remote processes"
-        for machine in RunConfiguration.machineSets[self.machineSet]:
-            machine = re.sub(r':.*', "", machine)
-            if machine.find(".") == -1:
-                machine = machine + "." + RunConfiguration.defaultDomain
-            processes = subprocess.Popen(["ssh", machine, "/bin/ps", "-o",
-                "pid:6,command"], stdout=subprocess.PIPE)
-            for line in processes.stdout:
-                if line.find(runId) != -1:
-                    pid = line[0:6].strip()
-                    # Ignore exit status
-                    subprocess.call(["ssh", machine, "/bin/kill", pid])
-            processes.wait()
-        time.sleep(5)
+        remaining = self._waitForExit(hosts, pattern, exclude,
+                RunConfiguration.shutdownWait)
+        for signal in ("TERM", "KILL"):
+            if len(remaining) == 0:
+                break
+            print >>sys.stderr, "sending SIG%s to remote processes on" % \
+                    (signal,), " ".join(remaining)
+            remaining = self._waitForExit(remaining, pattern, exclude,
+                    RunConfiguration.killWait, signal)
+        if len(remaining) > 0:
+            print >>sys.stderr, "*** processes may remain on", \
+                    " ".join(remaining)
         print >>sys.stderr, "unlocking machine set"
         self.unlockMachines()
 
+    def _waitForExit(self, hosts, pattern, exclude, timeout, signal=None):
+        """Poll hosts until none has a process whose command line matches
+        pattern or timeout seconds have passed, first sending signal to the
+        matching processes if given.  Like the pipelines, the processes
+        must have no controlling terminal, which leaves out interactive
+        commands (a tail of a log, say) that mention the run; exclude maps a
+        host to process ids to leave alone on it.  Returns the hosts that
+        still have such processes or did not answer."""
+        deadline = time.time() + timeout
+        command = "pgrep -t '?' -f '%s'" % (pattern,)
+        while True:
+            results = _sshAll(hosts, command)
+            pids = dict()
+            for host in hosts:
+                returnCode, output, elapsed = results[host]
+                if returnCode is None or returnCode > 1:
+                    pids[host] = []
+                    continue
+                pids[host] = [pid for pid in output.split()
+                        if int(pid) not in exclude.get(host, ())]
+                if len(pids[host]) == 0:
+                    del pids[host]
+            hosts = [host for host in hosts if pids.has_key(host)]
+            if len(hosts) > 0 and signal is not None:
+                _sshAll([host for host in hosts if len(pids[host]) > 0],
+                        dict([(host, "kill -%s %s" % (signal,
+                            " ".join(pids[host]))) for host in hosts]))
+                signal = None
+            elif len(hosts) == 0 or time.time() >= deadline:
+                return hosts
+            time.sleep(1)
+
     def checkForKill(self):
         with open(self._lockName(self.machineSet), "r") as lockFile:
             for line in lockFile:
@@ -859,14 +1664,7 @@ workflow: {
 
     def analyzeLogs(self, runId, inProgress=False):
         import MySQLdb
-        jobStartRegex = re.compile(
-                r"Processing job:"
-                r"(\s+filter=(?P<filter>\w)"
-                r"|\s+field=(?P<field>\d+)"
-                r"|\s+camcol=(?P<camcol>\d)"
-                r"|\s+run=(?P<run>\d+)"
-                r"|\s+type=calexp){5}"
-        )
+        import MySQLdb.cursors
 
         host = RunConfiguration.dbHost
         port = RunConfiguration.dbPort
@@ -885,7 +1683,17 @@ workflow: {
                         str([r[0] for r in ret]))
             dbName = ret[0][0]
 
-        result = ""
+        # Status polls resume from the analysis saved by the previous call so
+        # that only rows added since then are fetched
+        outputDir = os.path.join(self.options.output, runId)
+        statePath = os.path.join(outputDir, "run", "logAnalysis.json")
+        excerptPath = os.path.join(outputDir, "run",
+                "logAnalysisExcerpts.json")
+        if inProgress:
+            analysis = _loadLogAnalysis(statePath, excerptPath, dbName)
+        else:
+            analysis = LogAnalysis()
+
         try:
             conn = MySQLdb.connect(
                 host=host,
@@ -894,160 +1702,31 @@ workflow: {
                 passwd=DbAuth.password(host, str(port)),
                 db=dbName)
 
-            cursor = conn.cursor()
-            cursor.execute("""SELECT TIMESTAMP, timereceived FROM Logs
-                WHERE id = (SELECT MIN(id) FROM Logs)""")
-            row = cursor.fetchone()
-            if row is None:
-                if inProgress:
-                    return "No log entries yet\n"
-                else:
-                    return "*** No log entries written\n"
-            startTime, start = row
-            result += "First orca log entry: %s\n" % (start,)
-    
-            cursor = conn.cursor()
-            cursor.execute("""SELECT TIMESTAMP, timereceived FROM Logs
-                WHERE id = (SELECT MAX(id) FROM Logs)""")
-            stopTime, stop = cursor.fetchone()
-            result += "Last orca log entry: %s\n" % (stop,)
-            elapsed = long(stopTime) - long(startTime)
-            elapsedHr = elapsed / 3600 / 1000 / 1000 / 1000
-            elapsed -= elapsedHr * 3600 * 1000 * 1000 * 1000
-            elapsedMin = elapsed / 60 / 1000 / 1000 / 1000
-            elapsed -= elapsedMin * 60 * 1000 * 1000 * 1000
-            elapsedSec = elapsed / 1.0e9
-            result += "Orca elapsed time: %d:%02d:%06.3f\n" % (elapsedHr,
-                    elapsedMin, elapsedSec)
-    
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT COUNT(DISTINCT workerid) FROM
-                    (SELECT workerid FROM Logs LIMIT 10000) AS sample""")
-            nPipelines = cursor.fetchone()[0]
-            result += "%d pipelines used\n" % (nPipelines,)
-    
-            cursor = conn.cursor()
+            # Stream the table once rather than scanning it per statistic
+            cursor = conn.cursor(MySQLdb.cursors.SSDictCursor)
             cursor.execute("""
-                SELECT CASE gid
-                    WHEN 1 THEN 'pipeline shutdowns seen'
-                    WHEN 2 THEN 'CCDs attempted'
-                    WHEN 3 THEN 'src writes'
-                    WHEN 4 THEN 'calexp writes'
-                END AS descr, COUNT(*) FROM (
-                    SELECT CASE
-                        WHEN COMMENT LIKE 'Processing job:% filter=0%'
-                        THEN 1
-                        WHEN COMMENT LIKE 'Processing job:%'
-                            AND COMMENT NOT LIKE '% filter=0%'
-                        THEN 2
-                        WHEN COMMENT LIKE 'Ending write to BoostStorage%/src%'
-                        THEN 3
-                        WHEN COMMENT LIKE 'Ending write to FitsStorage%/calexp%'
-                        THEN 4
-                        ELSE 0
-                    END AS gid
-                    FROM Logs
-                ) AS stats WHERE gid > 0 GROUP BY gid""")
-            nShutdown = 0
-            for d, n in cursor.fetchall():
-                result += "%d %s\n" % (n, d)
-                if d == 'pipeline shutdowns seen':
-                    nShutdown = n
-            if nShutdown != nPipelines:
-                if not inProgress:
-                    if nShutdown == 0:
-                        result += "\n*** No pipelines were shut down properly\n"
-                    else:
-                        result += "\n*** Shutdowns do not match pipelines\n"
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT workerid, COMMENT
-                    FROM Logs JOIN
-                    (SELECT MAX(id) AS last FROM Logs GROUP BY workerid) AS a
-                    ON (Logs.id = a.last)""")
-                for worker, msg in cursor.fetchall():
-                    if inProgress:
-                        result += "Pipeline %s last status: %s\n" % (worker,
-                                msg)
-                    else:
-                        result += "Pipeline %s ended with: %s\n" % (worker, msg)
-    
-            cursor = conn.cursor()
-            cursor.execute("""
-SELECT COUNT(*) FROM Logs
-WHERE
-(
-    	COMMENT LIKE '%rror%'
-	OR COMMENT LIKE '%xception%'
-	OR COMMENT LIKE '%arning%'
-	OR COMMENT LIKE 'Fail'
-	OR COMMENT LIKE 'fail'
-)
-AND COMMENT NOT LIKE '%failureStage%'
-AND COMMENT NOT LIKE '%failure stage%'
-AND COMMENT NOT LIKE 'failSerialName%'
-AND COMMENT NOT LIKE 'failParallelName%'
-AND COMMENT NOT LIKE 'Distortion fitter failed to improve%'
-AND COMMENT NOT LIKE '%magnitude error column%'
-AND COMMENT NOT LIKE '%errorFlagged%'
-AND COMMENT NOT LIKE 'Skipping process due to error'
-            """)
-            result += "%s failures seen\n" % cursor.fetchone()
-
-            cursor = conn.cursor(MySQLdb.cursors.DictCursor)
-            cursor.execute("""
-                SELECT * FROM Logs
-                WHERE COMMENT LIKE 'Processing job:%'
-                    OR (
-                        (
-                            COMMENT LIKE '%rror%'
-                            OR COMMENT LIKE '%xception%'
-                            OR COMMENT LIKE '%arning%'
-                            OR COMMENT LIKE '%Fail%'
-                            OR COMMENT LIKE '%fail%'
-                        )
-                        AND COMMENT NOT LIKE '%failureStage%'
-                        AND COMMENT NOT LIKE '%failure stage%'
-                        AND COMMENT NOT LIKE 'failSerialName%'
-                        AND COMMENT NOT LIKE 'failParallelName%'
-                        AND COMMENT NOT LIKE 'Distortion fitter failed to improve%'
-                        AND COMMENT NOT LIKE '%magnitude error column%'
-                        AND COMMENT NOT LIKE '%errorFlagged%'
-                        AND COMMENT NOT LIKE 'Skipping process due to error'
-                    )
-                ORDER BY id;""")
-            jobs = dict()
-            for d in cursor.fetchall():
-                match = jobStartRegex.search(d['COMMENT'])
-                if match:
-                    jobs[d['workerid']] = "Band %s Run %s Camcol %s Frame %s" % (
-                            match.group("filter"), match.group("run"),
-                            match.group("camcol"), match.group("field"))
-                elif not d['COMMENT'].startswith('Processing job:'):
-                    if jobs.has_key(d['workerid']):
-                        job = jobs[d['workerid']]
-                    else:
-                        job = "unknown"
-                    result += "\n*** Error in %s in stage %s on %s:\n" % (
-                                job, d['stagename'], d['workerid'])
-                    lines = d['COMMENT'].split('\n')
-                    i = len(lines) - 1
-                    message = lines[i].strip()
-                    # Skip blank lines at end
-                    while i > 0 and message == "":
-                        i -= 1
-                        message = lines[i].strip()
-                    # Go back until we find a traceback line with " in "
-                    while i > 0 and lines[i].find(" in ") == -1:
-                        i -= 1
-                        message = lines[i].strip() + "\n" + message
-                    result += message + "\n"
-
+                SELECT id, TIMESTAMP, timereceived, workerid, stagename, COMMENT
+                FROM Logs WHERE id > %s ORDER BY id""", (analysis.lastId,))
+            while True:
+                rows = cursor.fetchmany(10000)
+                if len(rows) == 0:
+                    break
+                for d in rows:
+                    analysis.consume(d)
         finally:
             conn.close()
 
-        outputDir = os.path.join(self.options.output, runId)
+        try:
+            _saveLogAnalysis(analysis, statePath, excerptPath, dbName)
+        except (IOError, OSError):
+            pass
+
+        if len(analysis.durations) > 0:
+            self.updateCostModel(analysis.durations)
+        result = analysis.format(inProgress)
+        if analysis.first is None:
+            return result
+
         logFile = os.path.join(outputDir, "run", "unifiedPipeline.log")
         with open(logFile, "r") as log:
             try:
@@ -1159,6 +1838,10 @@ Uses the current stack and setup package versions.""")
         for entry in sorted(os.listdir(RunConfiguration.inputBase),
                 reverse=True):
             if entry.startswith("sdss"):
+                # Skip inputs already known to have nothing to process
+                manifest = self.readManifest(entry)
+                if manifest is not None and not manifest["ccds"]:
+                    continue
                 input = entry
                 break
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Check the vectorized comparators of endToEndCompare.py against the
+element-by-element comparisons they replaced, on random data that needs
+neither afw nor afwdata."""
+
+import unittest
+import lsst.utils.tests as utilsTests
+
+import random
+
+import numpy
+
+from endToEndCompare import calexpPlanes, cmpFloat, pixelCompare, \
+        sdqaAmpTableCompare, sourcesCompare
+
+class Angle(object):
+    def __init__(self, degrees):
+        self.degrees = degrees
+
+    def asDegrees(self):
+        return self.degrees
+
+class Source(object):
+    """Source stand-in: each getter returns a stored value"""
+
+    def __init__(self, values, nulls):
+        self.values = values
+        self.nulls = nulls
+
+    def __getattr__(self, name):
+        if name.startswith("get"):
+            return lambda: self.values[name]
+        raise AttributeError(name)
+
+    def isNull(self, num):
+        return num in self.nulls
+
+# (getter, null field number, tolerance, isAngle), as _srcFieldPlan makes
+_plan = [("getId", None, 1e-10, False), ("getRa", None, 1e-10, True),
+        ("getPsfFlux", 1, 1e-10, False), ("getPsfFluxErr", 2, 1e-6, False),
+        ("getXAstrom", 3, 1e-10, False), ("getDec", None, 1e-10, True)]
+
+def oldSourceCompare(t, plan, s1, s2):
+    """cmpSrc as it was before vectorization, with the reflection on afw
+    replaced by the plan"""
+    for getField, num, tol, isAngle in plan:
+        if num is not None:
+            if s1.isNull(num) != s2.isNull(num):
+                return "%s %s null: test %s, ref %s" % (t, getField,
+                        str(s1.isNull(num)), str(s2.isNull(num)))
+            if s1.isNull(num):
+                continue
+        v1 = getattr(s1, getField)()
+        v2 = getattr(s2, getField)()
+        if str(v1) == "nan" and str(v2) == "nan":
+            continue
+        if isAngle:
+            v1 = v1.asDegrees()
+            v2 = v2.asDegrees()
+        if cmpFloat(v1, v2, tol):
+            continue
+        return "%s %s: test %g, ref %g" % (t, getField, v1, v2)
+    return None
+
+def perturb(rng, v, tol):
+    """Return v, or a value that does or does not match it"""
+    choice = rng.randint(0, 7)
+    if choice == 0:
+        return v * (1 + 0.5 * tol)
+    if choice == 1:
+        return v * (1 + 10 * tol) + 10 * tol
+    if choice == 2:
+        return float("nan")
+    if choice == 3:
+        return 0.5 * tol
+    if choice == 4:
+        return -v
+    return v
+
+def makeSources(rng, n):
+    """Return a random pair of source lists that mostly agree"""
+    src1 = []
+    src2 = []
+    for i in xrange(n):
+        values1 = dict()
+        values2 = dict()
+        for getField, num, tol, isAngle in _plan:
+            v = rng.choice([0.0, 1.0, -3.5, 1e5, rng.uniform(-10, 10),
+                float("nan")])
+            values1[getField] = perturb(rng, v, tol)
+            values2[getField] = perturb(rng, v, tol)
+            if isAngle:
+                values1[getField] = Angle(values1[getField])
+                values2[getField] = Angle(values2[getField])
+        nulls1 = set(num for getField, num, tol, isAngle in _plan
+                if num is not None and rng.random() < 0.1)
+        nulls2 = set(num for getField, num, tol, isAngle in _plan
+                if num is not None and rng.random() < 0.1)
+        if rng.random() < 0.5:
+            nulls2 = set(nulls1)
+        src1.append(Source(values1, nulls1))
+        src2.append(Source(values2, nulls2))
+    return src1, src2
+
+class SourcesCompareTestCase(unittest.TestCase):
+    """Compare sourcesCompare with the old source-by-source walk.
+
+    Field values are floats: the old walk compared integer fields with
+    floor division, missing most differences, and that is deliberately not
+    reproduced.
+    """
+
+    def testEquivalence(self):
+        rng = random.Random(1)
+        nMismatches = 0
+        for trial in xrange(2000):
+            n = rng.choice([1, 2, 5, 20])
+            src1, src2 = makeSources(rng, n)
+            expected = None
+            for s1, s2 in zip(src1, src2):
+                expected = oldSourceCompare("src", _plan, s1, s2)
+                if expected is not None:
+                    nMismatches += 1
+                    break
+            self.assertEqual(sourcesCompare("src", src1, src2, _plan),
+                    expected)
+            report = dict(fields=dict())
+            self.assertEqual(sourcesCompare("src", src1, src2, _plan,
+                report), expected)
+            self.assertEqual(len(report["fields"]) > 0, expected is not None)
+        # Both outcomes are exercised
+        self.assert_(0 < nMismatches < 2000)
+
+def oldPixelCompare(planes1, planes2):
+    """The pixel checks of calexpCompare as they were before tiling: the
+    NaN-ignoring extremes of each whole difference image, image first,
+    then variance, then the sum of the xor of the masks"""
+    for (name, tol), p1, p2 in zip(calexpPlanes, planes1, planes2):
+        if tol is None:
+            total = numpy.bitwise_xor(p1, p2).sum(dtype=numpy.int64)
+            if total != 0:
+                return "calexp %s sum = %d" % (name, total)
+            continue
+        diff = p1 - p2
+        if numpy.nanmax(diff) > tol:
+            return "calexp %s max diff = %g" % (name, numpy.nanmax(diff))
+        if numpy.nanmin(diff) < -tol:
+            return "calexp %s min diff = %g" % (name, numpy.nanmin(diff))
+    return None
+
+def tiles(planes, tileRows):
+    for y0 in xrange(0, planes[0].shape[0], tileRows):
+        yield tuple(p[y0:y0 + tileRows] for p in planes)
+
+def makePlanes(rng, height, width):
+    """Return a random pair of (image, variance, mask) planes that differ
+    in a few pixels of a few planes"""
+    planes1 = (rng.normal(size=(height, width)).astype(numpy.float32),
+            rng.uniform(1, 2, size=(height, width)).astype(numpy.float32),
+            rng.randint(0, 1 << 16, size=(height, width)).astype(numpy.uint16))
+    planes2 = tuple(p.copy() for p in planes1)
+    for p in planes2:
+        if rng.randint(0, 3) != 0:
+            continue
+        for k in xrange(rng.randint(1, 4)):
+            y = rng.randint(0, height)
+            x = rng.randint(0, width)
+            if p.dtype == numpy.uint16:
+                p[y, x] ^= 1 << rng.randint(0, 16)
+            else:
+                p[y, x] += rng.choice([1e-9, -1e-9, 1e-3, -1e-3, 5.0, -5.0])
+    for p1, p2 in zip(planes1, planes2)[:2]:
+        if rng.randint(0, 4) == 0:
+            p1[rng.randint(0, height), rng.randint(0, width)] = numpy.nan
+    return planes1, planes2
+
+class PixelCompareTestCase(unittest.TestCase):
+    """Compare the tiled pixelCompare with the old whole-plane checks"""
+
+    def testEquivalence(self):
+        rng = numpy.random.RandomState(3)
+        nMismatches = 0
+        for trial in xrange(500):
+            height = rng.randint(1, 40)
+            width = rng.randint(1, 20)
+            planes1, planes2 = makePlanes(rng, height, width)
+            expected = oldPixelCompare(planes1, planes2)
+            if expected is not None:
+                nMismatches += 1
+            tileRows = rng.randint(1, height + 2)
+            self.assertEqual(pixelCompare(tiles(planes1, tileRows),
+                tiles(planes2, tileRows)), expected)
+        self.assert_(0 < nMismatches < 500)
+
+    def testReport(self):
+        """The report covers the whole exposure, whatever the tiling"""
+        rng = numpy.random.RandomState(4)
+        for trial in xrange(100):
+            planes1, planes2 = makePlanes(rng, 30, 10)
+            report = dict()
+            msg = pixelCompare(tiles(planes1, 7), tiles(planes2, 7),
+                    report=report)
+            self.assertEqual(msg is None,
+                    oldPixelCompare(planes1, planes2) is None)
+            for (name, tol), p1, p2 in zip(calexpPlanes, planes1, planes2):
+                entry = report[name]
+                self.assertEqual(entry["pixels"], p1.size)
+                if tol is None:
+                    diff = numpy.bitwise_xor(p1, p2)
+                    self.assertEqual(entry["badPixels"],
+                            numpy.count_nonzero(diff))
+                    bits = dict()
+                    for bit in xrange(16):
+                        n = numpy.count_nonzero((diff >> bit) & 1)
+                        if n > 0:
+                            bits[str(bit)] = n
+                    self.assertEqual(entry["bitDisagreements"], bits)
+                    continue
+                diff = p1 - p2
+                with numpy.errstate(invalid="ignore"):
+                    nBad = numpy.count_nonzero((diff > tol) | (diff < -tol))
+                self.assertEqual(entry["badPixels"], nBad)
+                finite = diff[numpy.isfinite(diff)]
+                self.assertEqual(entry["maxDiff"], max(0.0, finite.max()))
+                self.assertEqual(entry["minDiff"], min(0.0, finite.min()))
+
+def oldSdqaCompare(t, r1, r2):
+    """sdqaCompare of endToEnd.py, on (name, value, err, scope) tuples"""
+    if len(r1) != len(r2):
+        return "%s lengths: test %d, ref %d" % (t, len(r1), len(r2))
+    for (name1, value1, err1, scope1), (name2, value2, err2, scope2) in \
+            zip(r1, r2):
+        if name1 != name2:
+            return "%s names: test %s, ref %s" % (t, name1, name2)
+        if not cmpFloat(value1, value2):
+            return "%s %s values: test %g, ref %g" % (t, name1,
+                    value1, value2)
+        if not cmpFloat(err1, err2):
+            return "%s %s errors: test %g, ref %g" % (t, name1, err1, err2)
+        if scope1 != scope2:
+            return "%s %s scope: test %d, ref %d" % (t, name1,
+                    scope1, scope2)
+    return None
+
+def makeRatings(rng, snaps, channels):
+    """Return a random pair of sdqaAmp rating tables that mostly agree"""
+    names = ["overscanMean", "overscanStdDev", "nSaturated", "nBad"]
+    ratings1 = dict()
+    ratings2 = dict()
+    for snap in snaps:
+        for channel in channels:
+            rows1 = []
+            rows2 = []
+            for name in rng.sample(names, rng.randint(0, len(names))):
+                value = rng.choice([0.0, 1.0, -2.0, rng.uniform(0, 100)])
+                err = rng.choice([0.0, 0.5, float("nan")])
+                scope = rng.randint(0, 1)
+                rows1.append((name, perturb(rng, value, 1e-10),
+                    perturb(rng, err, 1e-10), scope))
+                rows2.append((name, perturb(rng, value, 1e-10),
+                    perturb(rng, err, 1e-10), scope))
+                if rng.random() < 0.05:
+                    rows2[-1] = (rng.choice(names),) + rows2[-1][1:3] + \
+                            (1 - scope,)
+            if len(rows1) > 0 and rng.random() < 0.05:
+                rows2.pop()
+            ratings1[(snap, channel)] = rows1
+            ratings2[(snap, channel)] = rows2
+    return ratings1, ratings2
+
+class SdqaAmpTableCompareTestCase(unittest.TestCase):
+    """Compare sdqaAmpTableCompare with sdqaCompare run on each amplifier,
+    including its rejection of NaN errors"""
+
+    def testEquivalence(self):
+        rng = random.Random(5)
+        channels = ["%d,%d" % (x, y) for x in xrange(2) for y in xrange(8)]
+        nMismatches = 0
+        for trial in xrange(200):
+            ratings1, ratings2 = makeRatings(rng, (0, 1), channels)
+            msgs = sdqaAmpTableCompare(ratings1, ratings2)
+            self.assertEqual(sorted(msgs.keys()), sorted(ratings1.keys()))
+            for amp in ratings1:
+                expected = oldSdqaCompare("sdqaAmp snap %s channel %s" % amp,
+                        ratings1[amp], ratings2[amp])
+                if expected is not None:
+                    nMismatches += 1
+                self.assertEqual(msgs[amp], expected)
+        self.assert_(nMismatches > 0)
+
+    def testMissing(self):
+        ratings = {(0, "0,0"): [("nBad", 1.0, 0.0, 0)]}
+        self.assertEqual(sdqaAmpTableCompare(ratings, dict()),
+                {(0, "0,0"): "sdqaAmp snap 0 channel 0,0 missing from ref"})
+        self.assertEqual(sdqaAmpTableCompare(dict(), ratings),
+                {(0, "0,0"): "sdqaAmp snap 0 channel 0,0 missing from test"})
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(SourcesCompareTestCase)
+    suites += unittest.makeSuite(PixelCompareTestCase)
+    suites += unittest.makeSuite(SdqaAmpTableCompareTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -28,12 +28,36 @@ from __future__ import with_statement
 import unittest
 import lsst.utils.tests as utilsTests
 
+import contextlib
+import errno
+import fcntl
 import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import pwd
 import re
+import resource
 import subprocess
 import sys
 import shutil
+try:
+    import sqlite3
+except ImportError:
+    # try external pysqlite package; deprecated
+    import sqlite as sqlite3
+import tempfile
+import threading
+import time
+
+import numpy
+try:
+    import pyfits
+except ImportError:
+    pyfits = None
 
 from ISR_ImSim import isrProcess
 from CcdAssembly_ImSim import ccdAssemblyProcess
@@ -41,10 +65,13 @@ from CrSplit_ImSim import crSplitProcess
 from ImgChar_ImSim import imgCharProcess
 from SFM_ImSim import sfmProcess
 
+from endToEndCompare import calexpPlanes, cmpFloat, pixelCompare, \
+        sdqaAmpTableCompare, sourceColumns, sourcesCompare
+
 import lsst.utils
 import lsst.afw.detection as afwDet
-import lsst.afw.math as afwMath
 import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.daf.persistence as dafPersist
 from lsst.obs.lsstSim import LsstSimMapper
 
@@ -54,13 +81,38 @@ except ImportError:
     print "warning: import of eups failed; tests will be skipped"
     sys.exit(0)
 
-def cmpFloat(v1, v2, tol=1e-10):
-    if v2 == 0.0:
-        return abs(v1) <= tol
-    else:
-        return abs(v1 - v2) / v2 <= tol
+# Rows of each calexp plane held in memory at once while comparing
+calexpTileRows = 256
+
+# Report every out-of-tolerance pixel instead of stopping at the first
+fullReport = bool(os.environ.get("ENDTOEND_FULL_REPORT"))
+
+# Write full difference statistics for every compared dataset here, as
+# JSON; sweeps add the CCD name to the file name
+diffReportPath = os.environ.get("ENDTOEND_DIFF_REPORT")
+
+# Number of dataset comparisons run concurrently
+compareThreads = int(os.environ.get("ENDTOEND_COMPARE_THREADS",
+    multiprocessing.cpu_count()))
+
+# Run the pipeline stages in the test process, passing intermediate
+# exposures in memory, instead of in a runImSim.py subprocess
+inProcess = (os.environ.get("ENDTOEND_MODE", "subprocess") == "inprocess")
+
+# Datasets compared against the reference; the only ones an in-process
+# run writes to disk
+comparedDatasets = ("icSrc", "src", "calexp", "psf", "sdqaAmp", "sdqaCcd")
 
-def calexpCompare(o1, o2):
+# Directory holding the per-test output roots
+workspaceBase = os.environ.get("ENDTOEND_WORKSPACE",
+        os.path.join(tempfile.gettempdir(),
+            "endToEnd-" + pwd.getpwuid(os.getuid())[0]))
+
+# Number of CCDs processed concurrently by the multi-CCD sweep
+sweepProcesses = int(os.environ.get("ENDTOEND_SWEEP_PROCESSES",
+    max(1, multiprocessing.cpu_count() / 2)))
+
+def _calexpHeaderCompare(o1, o2):
     w1 = o1.getWcs().getFitsMetadata().toString()
     w2 = o2.getWcs().getFitsMetadata().toString()
     if w1 != w2:
@@ -80,37 +132,196 @@ def calexpCompare(o1, o2):
     if c1.getFluxMag0() != c2.getFluxMag0():
         return "calexp calib exptime: test %s, ref %s" % (
                 str(c1.getFluxMag0()), str(c2.getFluxMag0()))
-    if o1.getHeight() != o2.getHeight():
-        return "calexp height: test %s, ref %s" % (o1.getHeight(), o2.getHeight())
-    if o1.getWidth() != o2.getWidth():
-        return "calexp width: test %s, ref %s" % (o1.getWidth(), o2.getWidth())
-
-    im = o1.getMaskedImage().getImage()
-    im -= o2.getMaskedImage().getImage()
-    st = afwMath.makeStatistics(im, afwMath.MAX | afwMath.MIN)
-    if st.getValue(afwMath.MAX) > 1.0e-8:
-        return "calexp img max diff = %g" % (st.getValue(afwMath.MAX),)
-    if st.getValue(afwMath.MIN) < -1.0e-8:
-        return "calexp img min diff = %g" % (st.getValue(afwMath.MIN),)
-
-    var = o1.getMaskedImage().getVariance()
-    var -= o2.getMaskedImage().getVariance()
-    st = afwMath.makeStatistics(var, afwMath.MAX | afwMath.MIN)
-    if st.getValue(afwMath.MAX) > 1.0e-8:
-        return "calexp var max diff = %g" % (st.getValue(afwMath.MAX),)
-    if st.getValue(afwMath.MIN) < -1.0e-8:
-        return "calexp var min diff = %g" % (st.getValue(afwMath.MIN),)
-
-    mask = o1.getMaskedImage().getMask()
-    mask ^= o2.getMaskedImage().getMask()
-    st = afwMath.makeStatistics(mask, afwMath.SUM)
-    if st.getValue(afwMath.SUM) != 0:
-        return "calexp mask sum = %d" % (st.getValue(afwMath.SUM),)
+    return None
+
+def _calexpSizeCompare(width1, height1, width2, height2):
+    if height1 != height2:
+        return "calexp height: test %s, ref %s" % (height1, height2)
+    if width1 != width2:
+        return "calexp width: test %s, ref %s" % (width1, width2)
+    return None
+
+# pyfits HDU index of each plane in an Exposure FITS file
+_calexpHdus = (1, 3, 2)
+
+def _fitsTiles(path, width, height, tileRows):
+    """Yield (image, variance, mask) arrays for successive row bands of an
+    Exposure FITS file, so that only one band is resident at a time.
+
+    Uses memory-mapped pyfits sections when pyfits is available and falls
+    back to reading each band as an afw sub-image otherwise.
+    """
+    if pyfits is not None:
+        fits = pyfits.open(path, memmap=True)
+        try:
+            sections = [fits[hdu].section for hdu in _calexpHdus]
+            for y0 in xrange(0, height, tileRows):
+                y1 = min(y0 + tileRows, height)
+                yield tuple(s[y0:y1, :] for s in sections)
+        finally:
+            fits.close()
+        return
+
+    for y0 in xrange(0, height, tileRows):
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, y0),
+                afwGeom.Extent2I(width, min(tileRows, height - y0)))
+        mi = afwImage.MaskedImageF(path, 0, None, bbox)
+        yield (mi.getImage().getArray(), mi.getVariance().getArray(),
+                mi.getMask().getArray())
+
+def calexpFileCompare(path1, path2, report=None):
+    """Compare two calexp FITS files without loading either one whole"""
+    # A 1x1 sub-image carries the WCS, metadata and calib
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1))
+    headerMsg = _calexpHeaderCompare(afwImage.ExposureF(path1, 0, bbox),
+            afwImage.ExposureF(path2, 0, bbox))
+    if headerMsg is not None and report is None:
+        return headerMsg
+    md1 = afwImage.readMetadata(path1, 2)
+    md2 = afwImage.readMetadata(path2, 2)
+    width, height = md1.get("NAXIS1"), md1.get("NAXIS2")
+    msg = _calexpSizeCompare(width, height,
+            md2.get("NAXIS1"), md2.get("NAXIS2"))
+    if msg is not None:
+        return headerMsg or msg
+    msg = pixelCompare(_fitsTiles(path1, width, height, calexpTileRows),
+            _fitsTiles(path2, width, height, calexpTileRows), fullReport,
+            report)
+    if headerMsg is not None:
+        report["header"] = headerMsg
+    return headerMsg or msg
+
+def calexpButlerCompare(butler, cmpButler, report=None, **keys):
+    return calexpFileCompare(_datasetPath(butler, "calexp", keys),
+            _datasetPath(cmpButler, "calexp", keys), report)
 
+def _sha1(*values):
+    h = hashlib.sha1()
+    for v in values:
+        h.update(str(v))
+    return h.hexdigest()
+
+def _arraySha1(h, a):
+    """Add the contents of array a, in native byte order, to hash h"""
+    h.update(numpy.ascontiguousarray(a,
+        dtype=a.dtype.newbyteorder("=")).tostring())
+
+def calexpDigest(butler, **keys):
+    path = _datasetPath(butler, "calexp", keys)
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1))
+    exposure = afwImage.ExposureF(path, 0, bbox)
+    calib = exposure.getCalib()
+    md = afwImage.readMetadata(path, 2)
+    width, height = md.get("NAXIS1"), md.get("NAXIS2")
+    digest = dict(
+            reader=("afw" if pyfits is None else "pyfits"),
+            size=_sha1(width, height),
+            wcs=_sha1(exposure.getWcs().getFitsMetadata().toString()),
+            header=_sha1(exposure.getMetadata().toString()),
+            calib=_sha1(calib.getMidTime().nsecs(), calib.getExptime(),
+                calib.getFluxMag0()))
+    hashes = [hashlib.sha1() for plane in calexpPlanes]
+    for bands in _fitsTiles(path, width, height, calexpTileRows):
+        for h, band in zip(hashes, bands):
+            _arraySha1(h, band)
+    for (name, tol), h in zip(calexpPlanes, hashes):
+        digest[name] = h.hexdigest()
+    return digest
+
+def srcDigest(butler, datasetType="src", **keys):
+    sources = butler.get(datasetType, **keys).getSources()
+    digest = dict(length=str(len(sources)))
+    if len(sources) == 0:
+        return digest
+    plan = _srcFieldPlan(sources[0])
+    for (getField, num, tol, isAngle), (values, nulls) in \
+            zip(plan, sourceColumns(sources, plan)):
+        h = hashlib.sha1()
+        _arraySha1(h, values)
+        if nulls is not None:
+            _arraySha1(h, nulls)
+        digest[getField] = h.hexdigest()
+    return digest
+
+def icSrcDigest(butler, **keys):
+    return srcDigest(butler, "icSrc", **keys)
+
+def sdqaDigest(butler, datasetType, **keys):
+    h = hashlib.sha1()
+    for r in butler.get(datasetType, **keys).getSdqaRatings():
+        h.update(repr((r.getName(), r.getValue(), r.getErr(),
+            r.getRatingScope())))
+    return dict(ratings=h.hexdigest())
+
+def sdqaCcdDigest(butler, **keys):
+    return sdqaDigest(butler, "sdqaCcd", **keys)
+
+def _filesEqual(path1, path2, chunkSize=1 << 24):
+    """Compare two files byte for byte through memory maps"""
+    size = os.path.getsize(path1)
+    if size != os.path.getsize(path2):
+        return False
+    if size == 0:
+        return True
+    with open(path1, "rb") as f1:
+        with open(path2, "rb") as f2:
+            m1 = mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ)
+            m2 = mmap.mmap(f2.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, chunkSize):
+                    if m1[offset:offset + chunkSize] != \
+                            m2[offset:offset + chunkSize]:
+                        return False
+            finally:
+                m1.close()
+                m2.close()
+    return True
+
+def psfCompare(o1, o2, width, height, nGrid=5, tol=1e-8):
+    """Compare two PSFs by their kernel images on an nGrid x nGrid grid of
+    positions over a width x height CCD; differences are relative to the
+    peak of the reference image"""
+    for iy in xrange(nGrid):
+        for ix in xrange(nGrid):
+            point = afwGeom.Point2D((ix + 0.5) * width / nGrid,
+                    (iy + 0.5) * height / nGrid)
+            a1 = o1.computeImage(point).getArray()
+            a2 = o2.computeImage(point).getArray()
+            if a1.shape != a2.shape:
+                return "psf image shape at (%g, %g): test %s, ref %s" % (
+                        point.getX(), point.getY(), a1.shape, a2.shape)
+            diff = numpy.abs(a1 - a2).max()
+            if diff > tol * numpy.abs(a2).max():
+                return "psf image at (%g, %g): max diff = %g" % (
+                        point.getX(), point.getY(), diff)
     return None
 
-def cmpSrc(t, s1, s2):
-    for getField in dir(s1):
+def psfButlerCompare(butler, cmpButler, report=None, **keys):
+    # Identical bytes are the common case; otherwise compare the PSFs
+    # themselves, as their serialization can change when they do not
+    if _filesEqual(_datasetPath(butler, "psf", keys),
+            _datasetPath(cmpButler, "psf", keys)):
+        return None
+    md = afwImage.readMetadata(_datasetPath(cmpButler, "calexp", keys), 2)
+    return psfCompare(butler.get("psf", **keys), cmpButler.get("psf", **keys),
+            md.get("NAXIS1"), md.get("NAXIS2"))
+
+# Source class -> list of (getter, null field number, tolerance, isAngle)
+_srcFieldPlans = dict()
+
+def _srcFieldPlan(s):
+    """Return the comparison plan for sources of the same class as s.
+
+    The plan is an ordered list of (getter name, null field number or None,
+    tolerance, isAngle) tuples.  It is built by reflection on the first
+    source of each class seen and reused for all later comparisons.
+    """
+    plan = _srcFieldPlans.get(type(s))
+    if plan is not None:
+        return plan
+
+    plan = []
+    for getField in dir(s):
         if not getField.startswith("get"):
             continue
         if getField in ("getAstrometry", "getPhotometry",
@@ -123,42 +334,28 @@ def cmpSrc(t, s1, s2):
         nullField = re.sub(r'.[A-Z]',
                 lambda m: m.group(0)[0] + '_' + m.group(0)[1], nullField)
         nullField = nullField.upper()
-        if hasattr(afwDet, nullField):
-            num = getattr(afwDet, nullField)
-            if s1.isNull(num) != s2.isNull(num):
-                return "%s %s null: test %s, ref %s" % (t, getField,
-                        str(s1.isNull(num)), str(s2.isNull(num)))
-            if s1.isNull(num):
-                continue
-
-        v1 = getattr(s1, getField)()
-        v2 = getattr(s2, getField)()
-        if str(v1) == "nan" and str(v2) == "nan":
-            continue
-        if type(v1) is afwGeom.Angle:
-            v1 = v1.asDegrees()
-            v2 = v2.asDegrees()
         if getField.find("Err") != -1:
-            if cmpFloat(v1, v2, 1e-6):
-                continue
+            tol = 1e-6
         else:
-            if cmpFloat(v1, v2):
-                continue
-        return "%s %s: test %g, ref %g" % (t, getField, v1, v2)
-    return None
+            tol = 1e-10
+        isAngle = type(getattr(s, getField)()) is afwGeom.Angle
+        plan.append((getField, getattr(afwDet, nullField, None), tol, isAngle))
+    _srcFieldPlans[type(s)] = plan
+    return plan
 
-def srcCompare(o1, o2, t="src"):
+def srcCompare(o1, o2, t="src", report=None):
     src1 = o1.getSources()
     src2 = o2.getSources()
+    if report is not None:
+        report.update(length=[len(src1), len(src2)], fields=dict())
     if len(src1) != len(src2):
         return "%s length: test %d, ref %d" % (t, len(src1), len(src2))
-    for s1, s2 in zip(src1, src2):
-        msg = cmpSrc(t, s1, s2)
-        if msg is not None:
-            return msg
+    if len(src1) == 0:
+        return None
+    return sourcesCompare(t, src1, src2, _srcFieldPlan(src1[0]), report)
 
-def icSrcCompare(o1, o2):
-    return srcCompare(o1, o2, t="icSrc")
+def icSrcCompare(o1, o2, report=None):
+    return srcCompare(o1, o2, t="icSrc", report=report)
 
 def sdqaCompare(t, o1, o2):
     r1 = o1.getSdqaRatings()
@@ -179,20 +376,901 @@ def sdqaCompare(t, o1, o2):
                     r1[i].getRatingScope(), r2[i].getRatingScope())
     return None
 
-def sdqaAmpCompare(o1, o2):
-    return sdqaCompare("sdqaAmp", o1, o2)
+def loadSdqaAmpRatings(butler, snap, channels, **keys):
+    """Read the sdqaAmp ratings of every channel of one snap of a sensor.
+
+    Returns a dict mapping (snap, channel) to a list of (name, value, err,
+    scope) tuples in rating order.
+    """
+    ratings = dict()
+    for channel in channels:
+        ratings[(snap, channel)] = [(r.getName(), r.getValue(), r.getErr(),
+            r.getRatingScope()) for r in butler.get("sdqaAmp", snap=snap,
+                channel=channel, **keys).getSdqaRatings()]
+    return ratings
 
-def sdqaCcdCompare(o1, o2):
+def sdqaCcdCompare(o1, o2, report=None):
     return sdqaCompare("sdqaCcd", o1, o2)
 
-def compare(butler, cmpButler, datasetType, **keys):
+class _RegistryCursor(object):
+    """Cursor of a _LockedConnection; rows are fetched in full while the
+    connection lock is held"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, *args):
+        with self.conn.lock:
+            cursor = self.conn.conn.execute(sql, *args)
+            self.description = cursor.description
+            self.rows = cursor.fetchall()
+        return self
+
+    def fetchone(self):
+        if len(self.rows) == 0:
+            return None
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+class _LockedConnection(object):
+    """sqlite3 connection that can be shared by several threads.
+
+    Python 2.7's sqlite3 refuses a connection from any thread but the one
+    that opened it, and concurrent cursors on one connection fail with
+    "Recursive use of cursors", so a file connection is reopened for use
+    from any thread and every statement runs under a lock.
+    """
+
+    def __init__(self, conn):
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        if path:
+            conn.close()
+            conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def cursor(self):
+        return _RegistryCursor(self)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+# registry file path -> (mtime, shared in-memory copy)
+_registries = dict()
+
+def _memoryRegistry(mapper):
+    """Replace the sqlite connection of a mapper's registry with an
+    in-memory copy of the registry file.
+
+    The copy is shared by every mapper using the same file and is safe to
+    query from several threads.
+    """
+    registry = getattr(mapper, "registry", None)
+    conn = getattr(registry, "conn", None)
+    if conn is None or isinstance(conn, _LockedConnection):
+        return
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    mtime = None
+    if path:
+        mtime = os.stat(path).st_mtime
+    cached = _registries.get(path)
+    if cached is not None and cached[0] == mtime:
+        memory = cached[1]
+    else:
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        db.executescript("\n".join(conn.iterdump()))
+        memory = _LockedConnection(db)
+        if path:
+            _registries[path] = (mtime, memory)
+    conn.close()
+    registry.conn = memory
+
+# (mapper class, root) -> Butler, for input repositories
+_butlers = dict()
+_butlersLock = threading.Lock()
+
+def getButler(root, registry=None, mapperClass=LsstSimMapper):
+    """Return a butler for a repository.
+
+    Butlers of input repositories (no registry given) are shared until
+    clearButlers() is called.  Output repositories, of which a sweep makes
+    one per CCD, get a new butler each time.  All butlers share one
+    in-memory copy of each registry file, so queries do not go back to
+    disk.
+    """
+    root = os.path.abspath(root)
+    with _butlersLock:
+        key = (mapperClass, root)
+        if registry is None and _butlers.has_key(key):
+            return _butlers[key]
+        if registry is None:
+            mapper = mapperClass(root=root)
+        else:
+            mapper = mapperClass(root=root,
+                    registry=os.path.abspath(registry))
+        _memoryRegistry(mapper)
+        butler = dafPersist.ButlerFactory(mapper=mapper).create()
+        if registry is None:
+            _butlers[key] = butler
+    return butler
+
+def clearButlers():
+    """Drop the shared butlers and registry copies, so that their mappers
+    and cameras do not outlive the test that made them"""
+    with _butlersLock:
+        _butlers.clear()
+        _registries.clear()
+
+def _datasetPath(butler, datasetType, dataId):
+    """Return the path of the file holding a dataset, without any HDU
+    suffix"""
+    path = butler.mapper.map(datasetType, dataId).getLocations()[0]
+    path = re.sub(r'\[.*\]$', "", path)
+    return os.path.normpath(os.path.join(butler.mapper.root, path))
+
+class DigestIndex(object):
+    """Persisted digests of reference datasets.
+
+    A dataset type with a <datasetType>Digest function can be accepted
+    without running its comparator when the digest of the test output
+    matches the digest of the reference.  Each entry records the size and
+    mtime of the reference file it was computed from and is recomputed
+    when that file changes.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+        self.changed = set()
+
+    def _load(self):
+        """Return the entries on disk; an unreadable index counts as empty"""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == DigestIndex.version:
+                return data["entries"]
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+        return dict()
+
+    def matches(self, butler, cmpButler, datasetType, keys):
+        digest = globals().get(datasetType + "Digest")
+        if digest is None:
+            return False
+        refPath = _datasetPath(cmpButler, datasetType, keys)
+        st = os.stat(refPath)
+        stamp = [st.st_size, st.st_mtime]
+        name = datasetType + " " + " ".join(
+                "%s=%s" % (k, keys[k]) for k in sorted(keys))
+        entry = self.entries.get(name)
+        if entry is None or entry["stamp"] != stamp:
+            entry = dict(stamp=stamp, digest=digest(cmpButler, **keys))
+            self.entries[name] = entry
+            self.changed.add(name)
+        return digest(butler, **keys) == entry["digest"]
+
+    def save(self):
+        """Merge the entries computed here into the index on disk.
+
+        Sweep workers save concurrently, so the merge is done under a lock
+        file and the index is replaced atomically.
+        """
+        if len(self.changed) == 0:
+            return
+        try:
+            with open(self.path + ".lock", "a") as lockFile:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+                entries = self._load()
+                for name in self.changed:
+                    entries[name] = self.entries[name]
+                tempFileDescriptor, tempFilename = tempfile.mkstemp(
+                        dir=os.path.dirname(os.path.abspath(self.path)))
+                try:
+                    with os.fdopen(tempFileDescriptor, "w") as f:
+                        json.dump(dict(version=DigestIndex.version,
+                            entries=entries), f, indent=1, sort_keys=True)
+                    os.chmod(tempFilename, 0644)
+                    os.rename(tempFilename, self.path)
+                except:
+                    os.unlink(tempFilename)
+                    raise
+        except (IOError, OSError), e:
+            print "warning: unable to save digest index %s: %s" % (
+                    self.path, e)
+            return
+        self.entries = entries
+        self.changed = set()
+
+def compare(butler, cmpButler, datasetType, digests=None, report=None,
+        **keys):
     '''
     butler: values to test
     cmpButler: truth
+    digests: optional DigestIndex of the truth
+    report: optional dict to fill with full difference statistics
+
+    A <datasetType>ButlerCompare function, if present, is handed the
+    butlers directly so that it can read the data itself; otherwise both
+    objects are retrieved and passed to <datasetType>Compare.
     '''
+    if digests is not None and \
+            digests.matches(butler, cmpButler, datasetType, keys):
+        if report is not None:
+            report["identical"] = True
+        return None
+    butlerCompare = globals().get(datasetType + "ButlerCompare")
+    if butlerCompare is not None:
+        return butlerCompare(butler, cmpButler, report=report, **keys)
     o1 = butler.get(datasetType, **keys)
     o2 = cmpButler.get(datasetType, **keys)
-    return eval(datasetType + "Compare(o1, o2)")
+    return globals()[datasetType + "Compare"](o1, o2, report=report)
+
+def runImSim(inputRoot, outputRoot, visit, raft, sensor):
+    """Process one CCD with runImSim.py; returns its exit status"""
+    return subprocess.call(["runImSim.py", "-T", "--force",
+        "-i", inputRoot, "-o", outputRoot,
+        "-v", str(visit), "-r", raft, "-s", sensor])
+
+def _procStatus(key):
+    """Return a "kB" field of /proc/self/status in bytes, or None"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def _procIo():
+    """Return (bytes read, bytes written) by this process so far"""
+    io = dict()
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                k, v = line.split(":")
+                io[k] = int(v)
+    except IOError:
+        pass
+    return io.get("rchar", 0), io.get("wchar", 0)
+
+class StageBenchmark(object):
+    """Wall time, CPU time, peak RSS and I/O of pipeline stages run in this
+    process.
+
+    Peak RSS is per stage where the kernel lets us reset the high-water
+    mark (/proc/self/clear_refs); otherwise it is the process peak at the
+    end of the stage.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def _resetPeakRss(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except IOError:
+            pass
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._resetPeakRss()
+        ru0 = resource.getrusage(resource.RUSAGE_SELF)
+        read0, written0 = _procIo()
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            wallTime = time.time() - t0
+            ru1 = resource.getrusage(resource.RUSAGE_SELF)
+            read1, written1 = _procIo()
+            peakRss = _procStatus("VmHWM")
+            if peakRss is None:
+                peakRss = ru1.ru_maxrss * 1024
+            self.stages.append(dict(name=name,
+                wallTime=wallTime,
+                cpuTime=(ru1.ru_utime + ru1.ru_stime) -
+                    (ru0.ru_utime + ru0.ru_stime),
+                peakRss=peakRss,
+                readBytes=read1 - read0,
+                writeBytes=written1 - written0))
+
+    def write(self, path, **info):
+        report = dict(info, stages=self.stages)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+class PerfHistory(object):
+    """SQLite history of end-to-end benchmark results.
+
+    Each recorded run is keyed by a digest of the eups setup snapshot and
+    holds one value per (stage, metric).  regressions() compares a run with
+    the rolling baseline formed by the runs of the same CCD and execution
+    mode recorded before it.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL, ccd TEXT, setupDigest TEXT, setups TEXT,
+                mode TEXT);
+            CREATE TABLE IF NOT EXISTS metrics (
+                run INTEGER, stage TEXT, metric TEXT, value REAL);
+            CREATE INDEX IF NOT EXISTS metricsByName
+                ON metrics (stage, metric, run);
+            """)
+        # Histories written before the mode was recorded; their runs are
+        # never used as a baseline
+        columns = [row[1] for row in
+                self.conn.execute("PRAGMA table_info(runs)")]
+        if "mode" not in columns:
+            self.conn.execute("ALTER TABLE runs ADD COLUMN mode TEXT")
+
+    def record(self, ccd, mode, metrics):
+        """Store metrics, a list of (stage, metric, value), for the current
+        eups setup and the given execution mode; returns the new run id"""
+        setups = "\n".join(sorted("%s %s" % (p.name, p.version)
+            for p in eups.Eups().getSetupProducts()))
+        with self.conn:
+            cursor = self.conn.execute("""INSERT INTO runs
+                (time, ccd, setupDigest, setups, mode)
+                VALUES (?, ?, ?, ?, ?)""",
+                (time.time(), ccd, _sha1(setups), setups, mode))
+            runId = cursor.lastrowid
+            self.conn.executemany("""INSERT INTO metrics
+                (run, stage, metric, value) VALUES (?, ?, ?, ?)""",
+                [(runId, stage, metric, value)
+                    for stage, metric, value in metrics])
+        return runId
+
+    def regressions(self, runId, window=10, sigma=3.0, slack=0.05,
+            minRuns=3):
+        """Return a message for each metric of run runId that exceeds the
+        mean of the previous window runs of the same CCD and mode by more
+        than sigma standard deviations and by more than a fraction slack,
+        followed by the setup changes since the previous such run if any
+        metric did"""
+        ccd, mode = self.conn.execute("""SELECT ccd, mode FROM runs
+            WHERE id = ?""", (runId,)).fetchone()
+        msgs = []
+        for stage, metric, value in self.conn.execute("""SELECT
+                stage, metric, value FROM metrics WHERE run = ?
+                ORDER BY stage, metric""", (runId,)).fetchall():
+            history = numpy.array([v for (v,) in self.conn.execute("""
+                SELECT value FROM metrics JOIN runs ON (metrics.run = runs.id)
+                WHERE stage = ? AND metric = ? AND ccd = ? AND mode = ?
+                    AND run < ?
+                ORDER BY run DESC LIMIT ?""",
+                (stage, metric, ccd, mode, runId, window))])
+            if len(history) < minRuns:
+                continue
+            mean = history.mean()
+            limit = mean + max(sigma * history.std(), slack * abs(mean))
+            if value > limit:
+                msgs.append("%s %s regressed: %g vs baseline %g "
+                        "(limit %g over %d runs)" %
+                        (stage, metric, value, mean, limit, len(history)))
+        if msgs:
+            msgs.extend(self._setupChanges(runId, ccd, mode))
+        return msgs
+
+    def _setupChanges(self, runId, ccd, mode):
+        """Return a message for each product whose version differs between
+        run runId and the previous run of the same CCD and mode"""
+        current = self.conn.execute("""SELECT setupDigest, setups FROM runs
+            WHERE id = ?""", (runId,)).fetchone()
+        previous = self.conn.execute("""SELECT setupDigest, setups FROM runs
+            WHERE ccd = ? AND mode = ? AND id < ? ORDER BY id DESC LIMIT 1""",
+            (ccd, mode, runId)).fetchone()
+        if previous is None or previous[0] == current[0]:
+            return []
+        before = dict(line.split(" ", 1) for line in previous[1].split("\n")
+                if line)
+        after = dict(line.split(" ", 1) for line in current[1].split("\n")
+                if line)
+        msgs = []
+        for product in sorted(set(before) | set(after)):
+            if before.get(product) != after.get(product):
+                msgs.append("setup changed since last run: %s %s -> %s" %
+                        (product, before.get(product), after.get(product)))
+        return msgs
+
+class MemoryButler(object):
+    """Butler stand-in for chaining pipeline stages in one process.
+
+    Datasets whose type is in persist are written through to the real
+    butler; every other stage output is kept in memory and handed to the
+    next stage without a round trip through disk.  Anything not held in
+    memory is read from the real butler.
+    """
+
+    def __init__(self, butler, persist):
+        self.butler = butler
+        self.persist = set(persist)
+        self.datasets = dict()
+
+    def __getattr__(self, name):
+        return getattr(self.butler, name)
+
+    def _key(self, datasetType, dataId, rest):
+        dataId = dict(dataId)
+        dataId.update(rest)
+        return (datasetType, tuple(sorted(dataId.items())))
+
+    def put(self, obj, datasetType, dataId={}, **rest):
+        if datasetType in self.persist:
+            self.butler.put(obj, datasetType, dataId, **rest)
+        else:
+            self.datasets[self._key(datasetType, dataId, rest)] = obj
+
+    def get(self, datasetType, dataId={}, immediate=False, **rest):
+        key = self._key(datasetType, dataId, rest)
+        if key in self.datasets:
+            return self.datasets[key]
+        return self.butler.get(datasetType, dataId, immediate=immediate,
+                **rest)
+
+    def datasetExists(self, datasetType, dataId={}, **rest):
+        if self._key(datasetType, dataId, rest) in self.datasets:
+            return True
+        return self.butler.datasetExists(datasetType, dataId, **rest)
+
+    def subset(self, datasetType, level=None, dataId={}, **rest):
+        # References in the subset must read through this butler
+        dataId = dict(dataId)
+        dataId.update(rest)
+        return dafPersist.ButlerSubset(self, datasetType, level, dataId)
+
+    def drop(self, datasetType):
+        """Release all in-memory datasets of a type"""
+        for key in self.datasets.keys():
+            if key[0] == datasetType:
+                del self.datasets[key]
+
+def _treeState(root):
+    """Return a dict mapping each file below root to its (size, mtime)"""
+    state = dict()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            st = os.stat(path)
+            state[os.path.relpath(path, root)] = (st.st_size, st.st_mtime)
+    return state
+
+def _copyTree(src, dest):
+    """Copy every file below src into the same place below dest"""
+    for dirpath, dirnames, filenames in os.walk(src):
+        destDir = os.path.join(dest, os.path.relpath(dirpath, src))
+        if not os.path.isdir(destDir):
+            os.makedirs(destDir)
+        for f in filenames:
+            target = os.path.join(destDir, f)
+            if os.path.lexists(target):
+                os.unlink(target)
+            _copyFile(os.path.join(dirpath, f), target)
+
+# Calibration datasets read by ISR along with each raw channel
+isrCalibrations = ("bias", "dark", "flat")
+
+def _inputDigest(inButler, snaps, channels, **ccd):
+    """Return a digest of the contents of every raw file of a CCD and of
+    the calibration files ISR applies to them"""
+    h = hashlib.sha1()
+    seen = set()
+    for snap in snaps:
+        for channel in channels:
+            dataId = dict(ccd, snap=snap, channel=channel)
+            for datasetType in ("raw",) + isrCalibrations:
+                path = _datasetPath(inButler, datasetType, dataId)
+                # Calibrations are shared by the snaps
+                if path in seen:
+                    continue
+                seen.add(path)
+                h.update(datasetType)
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), ""):
+                        h.update(chunk)
+    return h.hexdigest()
+
+class StageCache(object):
+    """Content-addressed cache of the files written by the ISR, CcdAssembly
+    and CrSplit stages.
+
+    A stage's key covers the digest of the raw and calibration input, the
+    key of the stage before it and the eups versions of the packages it
+    depends on, so a change to any of those invalidates that stage and
+    every later one.
+    Entries are evicted least recently used first once the cache grows
+    beyond its budget in bytes.
+    """
+
+    # Packages whose versions are part of every stage key
+    commonPackages = ("afw", "daf_persistence", "daf_butlerUtils",
+            "obs_lsstSim", "pex_policy", "datarel")
+    # Cached stages, in order, with the packages each one depends on
+    stagePackages = (
+            ("isr", ("ip_isr",)),
+            ("ccdAssembly", ("ip_isr",)),
+            ("crSplit", ("ip_pipeline", "meas_algorithms")),
+    )
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        try:
+            os.makedirs(root)
+        except OSError:
+            if not os.path.isdir(root):
+                raise
+        self.versions = dict((p.name, p.version)
+                for p in eups.Eups().getSetupProducts())
+
+    def stageKeys(self, inputDigest):
+        """Return the key of each cached stage for the given input"""
+        keys = []
+        key = inputDigest
+        for stage, packages in self.stagePackages:
+            versions = ["%s %s" % (p, self.versions.get(p))
+                    for p in self.commonPackages + packages]
+            key = _sha1(stage, key, *versions)
+            keys.append(key)
+        return keys
+
+    def restore(self, keys, outputRoot):
+        """Copy the cached outputs of the stages with the given keys into
+        outputRoot; returns False unless every one of them was cached.
+        The copies are reflinks where possible but never hard links, so a
+        later stage rewriting a restored file cannot corrupt the cache."""
+        entries = [os.path.join(self.root, key) for key in keys]
+        if not all(os.path.isdir(entry) for entry in entries):
+            return False
+        try:
+            for entry in entries:
+                _copyTree(entry, outputRoot)
+                os.utime(entry, None)
+        except (IOError, OSError):
+            # Evicted underneath us
+            return False
+        return True
+
+    def store(self, key, outputRoot, before):
+        """Cache the files in outputRoot written since the _treeState
+        snapshot before"""
+        tmpDir = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        for path, st in _treeState(outputRoot).iteritems():
+            if before.get(path) == st:
+                continue
+            dest = os.path.join(tmpDir, path)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy2(os.path.join(outputRoot, path), dest)
+        try:
+            os.rename(tmpDir, os.path.join(self.root, key))
+        except OSError:
+            # Stored concurrently by another process
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.root, name)
+            size = sum(st[0] for st in _treeState(path).itervalues())
+            entries.append((os.stat(path).st_mtime, size, path))
+            total += size
+        for mtime, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+def runStages(inButler, outButler, visit, raft, sensor, benchmark=None,
+        inMemory=False, cache=None, outputRoot=None):
+    """Run ISR, CcdAssembly, CrSplit, ImgChar and SFM on one CCD in this
+    process, as runImSim.py does, timing each stage in benchmark.
+
+    If inMemory is set, intermediate exposures are passed between stages
+    in memory and only the compared datasets are written to outButler.
+    If a StageCache is given, the longest run of leading stages whose
+    outputs are cached is restored into outputRoot instead of being rerun;
+    those stages always write to disk so that their outputs can be cached.
+    """
+    if benchmark is None:
+        benchmark = StageBenchmark()
+    diskButler = outButler
+    if inMemory:
+        outButler = MemoryButler(outButler, comparedDatasets)
+    ccd = dict(visit=visit, raft=raft, sensor=sensor)
+    snaps = inButler.queryMetadata("raw", "snap", **ccd)
+    channels = inButler.queryMetadata("raw", "channel", **ccd)
+
+    def isr(butler):
+        for snap in snaps:
+            for channel in channels:
+                isrProcess(inButler=inButler, outButler=butler,
+                        snap=snap, channel=channel, **ccd)
+
+    def ccdAssembly(butler):
+        for snap in snaps:
+            ccdAssemblyProcess(inButler=butler, outButler=butler,
+                    snap=snap, **ccd)
+
+    def crSplit(butler):
+        crSplitProcess(inButler=butler, outButler=butler, **ccd)
+
+    def imgChar(butler):
+        imgCharProcess(inButler=butler, outButler=butler, **ccd)
+
+    def sfm(butler):
+        sfmProcess(inButler=butler, outButler=butler, **ccd)
+
+    # Stage name, function, intermediate dataset no longer needed after it
+    stages = (
+            ("isr", isr, None),
+            ("ccdAssembly", ccdAssembly, "postISR"),
+            ("crSplit", crSplit, "postISRCCD"),
+            ("imgChar", imgChar, None),
+            ("sfm", sfm, None),
+    )
+
+    keys = []
+    start = 0
+    if cache is not None:
+        keys = cache.stageKeys(_inputDigest(inButler, snaps, channels,
+                **ccd))
+        with benchmark.stage("cacheRestore"):
+            for i in xrange(len(keys), 0, -1):
+                if cache.restore(keys[:i], outputRoot):
+                    start = i
+                    break
+
+    for i, (name, stage, consumed) in enumerate(stages):
+        if i < start:
+            continue
+        if i < len(keys):
+            before = _treeState(outputRoot)
+            with benchmark.stage(name):
+                stage(diskButler)
+            cache.store(keys[i], outputRoot, before)
+        else:
+            with benchmark.stage(name):
+                stage(outButler)
+        if inMemory and consumed is not None:
+            outButler.drop(consumed)
+    return benchmark
+
+def compareCcd(inputRoot, outputRoot, digests, reportPath=None, **dataId):
+    """Compare the outputs of one CCD with the reference outputs.
+
+    Returns a list of (label, message) pairs in a fixed order; message is
+    None for each dataset that matches.  If reportPath is given, full
+    difference statistics for every dataset are written there as JSON.
+    """
+    registryPath = os.path.join(inputRoot, "registry.sqlite3")
+
+    inButler = getButler(inputRoot)
+    outButler = getButler(outputRoot, registryPath)
+
+    snaps = (0, 1)
+    jobs = [("psf", "psf", dataId)]
+    for datasetType in ("icSrc", "src", "calexp"):
+        jobs.append((datasetType, datasetType, dataId))
+    for snap in snaps:
+        jobs.append(('sdqaCcd snap %i' % snap, "sdqaCcd",
+            dict(dataId, snap=snap)))
+    channels = inButler.queryMetadata("raw", "channel")
+
+    reports = dict()
+
+    def runJob(job):
+        label, datasetType, keys = job
+        report = None
+        if reportPath is not None:
+            report = reports[label] = dict()
+        return compare(outButler, inButler, datasetType, digests, report,
+                **keys)
+
+    # Comparisons are independent; map() keeps results in job order.  The
+    # sdqaAmp ratings are read a snap at a time on the same pool and
+    # compared together afterwards
+    pool = ThreadPool(compareThreads)
+    try:
+        ampLoads = [[pool.apply_async(loadSdqaAmpRatings,
+            (butler, snap, channels), dataId) for snap in snaps]
+            for butler in (outButler, inButler)]
+        msgs = pool.map(runJob, jobs)
+        ampRatings = []
+        for loads in ampLoads:
+            ratings = dict()
+            for load in loads:
+                ratings.update(load.get())
+            ampRatings.append(ratings)
+    finally:
+        pool.close()
+        pool.join()
+    ampMsgs = sdqaAmpTableCompare(*ampRatings)
+
+    results = [(label, msg) for (label, datasetType, keys), msg in
+            zip(jobs, msgs)]
+    for snap in snaps:
+        for channel in channels:
+            results.append(('sdqaAmp snap %i channel ' % (snap) +
+                str(channel), ampMsgs.get((snap, channel))))
+
+    for label, msg in results:
+        if msg is not None:
+            print label, 'differs (but carrying on and failing later...)'
+            print 'message:', msg
+
+    if reportPath is not None:
+        for label, msg in results:
+            reports.setdefault(label, dict())["message"] = msg
+        with open(reportPath, "w") as f:
+            json.dump(reports, f, indent=1, sort_keys=True)
+    return results
+
+def discardTree(path):
+    """Remove a directory tree without waiting for it to be deleted.
+
+    The tree is renamed into a trash directory below workspaceBase, which
+    is O(1), and then deleted by a background process that may outlive this
+    one.  The trash is not put beside the tree, where it would show up in
+    listings of the sweep root.
+    """
+    trash = os.path.join(workspaceBase, ".endToEnd-trash")
+    if not os.path.isdir(trash):
+        os.makedirs(trash)
+    target = tempfile.mkdtemp(prefix=os.path.basename(path) + "-", dir=trash)
+    try:
+        os.rename(path, os.path.join(target, "tree"))
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Not on the trash's filesystem; move it aside where it is
+        os.rmdir(target)
+        target = tempfile.mkdtemp(prefix=".endToEnd-trash-",
+                dir=os.path.dirname(os.path.abspath(path)))
+        os.rename(path, os.path.join(target, "tree"))
+    subprocess.Popen(["rm", "-rf", target], close_fds=True)
+
+def _copyFile(src, dest):
+    """Copy src to dest, as a copy-on-write reflink where the filesystem
+    supports one"""
+    if subprocess.call(["cp", "--reflink=auto", src, dest]) != 0:
+        shutil.copy2(src, dest)
+
+class Workspace(object):
+    """Scratch output root for one test.
+
+    The workspace is a fresh directory below base, populated with copies
+    of the inputs the test needs, and is thrown away with discardTree().
+    The copies are never hard links, so writes to them (the registry, for
+    example) cannot reach the originals.
+    """
+
+    def __init__(self, base, name, inputs=()):
+        if not os.path.isdir(base):
+            os.makedirs(base)
+        self.path = tempfile.mkdtemp(prefix=name + "-", dir=base)
+        for src in inputs:
+            _copyFile(src, os.path.join(self.path, os.path.basename(src)))
+
+    def discard(self):
+        if self.path is not None and os.path.exists(self.path):
+            discardTree(self.path)
+        self.path = None
+
+def _ccdName(visit, raft, sensor):
+    return "v%d-R%s-S%s" % (visit, re.sub(r',', "", raft),
+            re.sub(r',', "", sensor))
+
+def sweepCcd(args):
+    """Process and check one CCD of a sweep in its own output root.
+
+    Returns a dict with the CCD, its status (pass, fail, noref or error),
+    timings and any mismatch messages.  Output roots of failing CCDs are
+    kept for inspection; the others are discarded.
+    """
+    inputRoot, sweepRoot, visit, raft, sensor = args
+    ccd = _ccdName(visit, raft, sensor)
+    outputRoot = os.path.join(sweepRoot, ccd)
+    result = dict(ccd=ccd, status="error", runTime=0.0, compareTime=0.0,
+            messages=[])
+    try:
+        # Without reference outputs there is nothing to check against, so
+        # do not spend time processing the CCD
+        inButler = getButler(inputRoot)
+        if not inButler.datasetExists("calexp", visit=visit, raft=raft,
+                sensor=sensor):
+            result["status"] = "noref"
+            return result
+
+        os.mkdir(outputRoot)
+        t0 = time.time()
+        if inProcess:
+            outButler = getButler(outputRoot,
+                    os.path.join(inputRoot, "registry.sqlite3"))
+            runStages(inButler, outButler, visit, raft, sensor,
+                    inMemory=True, cache=_stageCache(), outputRoot=outputRoot)
+        else:
+            stat = runImSim(inputRoot, outputRoot, visit, raft, sensor)
+            if stat != 0:
+                result["runTime"] = time.time() - t0
+                result["messages"].append("runImSim.py exited with %d" %
+                        (stat,))
+                return result
+        result["runTime"] = time.time() - t0
+
+        t0 = time.time()
+        digests = DigestIndex(_digestIndexPath(inputRoot))
+        reportPath = None
+        if diffReportPath:
+            reportPath = "%s-%s.json" % (os.path.splitext(diffReportPath)[0],
+                    ccd)
+        results = compareCcd(inputRoot, outputRoot, digests, reportPath,
+                visit=visit, raft=raft, sensor=sensor)
+        digests.save()
+        result["compareTime"] = time.time() - t0
+        result["messages"] = [msg for label, msg in results if msg is not None]
+        if len(result["messages"]) == 0:
+            result["status"] = "pass"
+            discardTree(outputRoot)
+        else:
+            result["status"] = "fail"
+    except Exception, e:
+        result["messages"].append("%s: %s" % (type(e).__name__, e))
+    return result
+
+def _sweepCcds(inputRoot, spec):
+    """Return the (visit, raft, sensor) list described by spec: either
+    "all" for every sensor in the input registry that has reference
+    outputs, or whitespace-separated visit:raft:sensor entries such as
+    85408556:2,3:1,1"""
+    if spec == "all":
+        inButler = getButler(inputRoot)
+        return [(visit, raft, sensor) for visit, raft, sensor in
+                sorted(inButler.queryMetadata("raw", "sensor",
+                    ("visit", "raft", "sensor")))
+                if inButler.datasetExists("calexp", visit=visit, raft=raft,
+                    sensor=sensor)]
+    ccds = []
+    for entry in spec.split():
+        visit, raft, sensor = entry.split(":")
+        ccds.append((int(visit), raft, sensor))
+    return ccds
+
+def _stageCache():
+    """Return the StageCache configured by ENDTOEND_STAGE_CACHE (a
+    directory) and ENDTOEND_STAGE_CACHE_BYTES, or None"""
+    root = os.environ.get("ENDTOEND_STAGE_CACHE")
+    if not root:
+        return None
+    return StageCache(root,
+            int(float(os.environ.get("ENDTOEND_STAGE_CACHE_BYTES", 20e9))))
+
+def _digestIndexPath(inputRoot):
+    return os.environ.get("ENDTOEND_DIGEST_INDEX",
+            os.path.join(inputRoot, "endToEndDigests.json"))
 
 class EndToEndTestCase(unittest.TestCase):
     """Testing end to end (through SFM) PT1 processing"""
@@ -201,17 +1279,25 @@ class EndToEndTestCase(unittest.TestCase):
 
     def _ensureClean(self):
         if os.path.exists(self.tmpdir):
-            shutil.rmtree(self.tmpdir)
+            discardTree(self.tmpdir)
 
     def setUp(self):
         self._ensureClean()
+        self.workspace = None
+        self.passed = False
 
     def tearDown(self):
         self._ensureClean()
+        clearButlers()
+        if self.workspace is None:
+            return
+        # Outputs of a failed test are kept for inspection
+        if not self.passed:
+            print "Test outputs kept in", self.workspace.path
+        elif not os.environ.get("ENDTOEND_KEEP_WORKSPACE"):
+            self.workspace.discard()
 
-    def testEndToEnd(self):
-        """Test ISR, CcdAssembly, CrSplit, ImgChar, SFM pipelines"""
-
+    def _setupAstrometryNetData(self):
         #Setup up astrometry_net_data
         # Note - one of datarel's dependencies causes setup of
         #        'astrometry_net_data cfhttemplate' version; 
@@ -223,65 +1309,127 @@ class EndToEndTestCase(unittest.TestCase):
         if not ok:
             raise ValueError("Couldn't set up version '%s' of astrometry_net_data: %s" % (ver, reason))
 
+    def testEndToEnd(self):
+        """Test ISR, CcdAssembly, CrSplit, ImgChar, SFM pipelines"""
+
+        self._setupAstrometryNetData()
+
         afwdataDir = lsst.utils.getPackageDir("afwdata")
         inputRoot = os.path.join(afwdataDir, "ImSim")
-        if os.path.exists("endToEnd.py"):
-            outputRoot = "."
+        self.workspace = Workspace(workspaceBase, "endToEnd",
+                [os.path.join(inputRoot, "registry.sqlite3")])
+        outputRoot = self.workspace.path
+
+        digests = DigestIndex(_digestIndexPath(inputRoot))
+
+        ccd = _ccdName(85408556, "2,3", "1,1")
+        benchmarkPath = os.environ.get("ENDTOEND_BENCHMARK")
+        perfDbPath = os.environ.get("ENDTOEND_PERF_DB")
+        benchmark = None
+        cache = _stageCache()
+        if benchmarkPath or perfDbPath or inProcess or cache is not None:
+            # Stages in this process, one at a time
+            registryPath = os.path.join(inputRoot, "registry.sqlite3")
+            inButler = getButler(inputRoot)
+            outButler = getButler(outputRoot, registryPath)
+            benchmark = runStages(inButler, outButler, 85408556, "2,3", "1,1",
+                    inMemory=inProcess, cache=cache, outputRoot=outputRoot)
+            if benchmarkPath:
+                benchmark.write(benchmarkPath, ccd=ccd)
         else:
-            outputRoot = "tests"
-
-        registryPath = os.path.join(inputRoot, "registry.sqlite3")
-
-        bf = dafPersist.ButlerFactory(mapper=LsstSimMapper(root=inputRoot))
-        inButler = bf.create()
-        obf = dafPersist.ButlerFactory(mapper=LsstSimMapper(root=outputRoot,
-            registry=registryPath))
-        outButler = obf.create()
-
-        stat = subprocess.call(["runImSim.py", "-T", "--force",
-            "-i", inputRoot, "-o", outputRoot,
-            "-v", "85408556", "-r", "2,3", "-s", "1,1"])
-        self.assertEqual(stat, 0, "Error while running end to end test")
-
-        fname = "psf/v85408556-fr/R23/S11.boost"
-        stat = subprocess.call(["cmp",
-            os.path.join(outputRoot, fname), os.path.join(inputRoot, fname)])
-
-        psfDiffers = (stat != 0)
-        if psfDiffers:
-            print 'PSF differs (but carrying on and failing later...)'
-
-        results = []
-        
-        for datasetType in ("icSrc", "src", "calexp"):
-            msg = compare(outButler, inButler, datasetType,
-                    visit=85408556, raft="2,3", sensor="1,1")
-            results.append((datasetType, msg))
-            if msg is not None:
-                print 'Dataset type', datasetType, 'differs (but carrying on and failing later...)'
-                print 'message:', msg
-
-        for snap in (0, 1):
-            msg = compare(outButler, inButler, "sdqaCcd",
-                visit=85408556, snap=snap, raft="2,3", sensor="1,1")
-            results.append(('sdqaCcd snap %i' % snap, msg))
-            if msg is not None:
-                print 'Snap', snap, 'sdqaCCD differs (but carrying on and failing later...)'
-                print 'message:', msg
-            for channel in inButler.queryMetadata("raw", "channel"):
-                msg = compare(outButler, inButler, "sdqaAmp",
-                    visit=85408556, snap=snap, raft="2,3", sensor="1,1",
-                    channel=channel)
-                print 'channel:', channel
-                results.append(('sdqaAmp snap %i channel ' % (snap) + str(channel), msg))
-                if msg is not None:
-                    print 'Snap', snap, 'channel', channels, 'sdqaAmp differs (but carrying on and failing later...)'
-                    print 'message:', msg
+            stat = runImSim(inputRoot, outputRoot, 85408556, "2,3", "1,1")
+            self.assertEqual(stat, 0, "Error while running end to end test")
+
+        results = compareCcd(inputRoot, outputRoot, digests, diffReportPath,
+                visit=85408556, raft="2,3", sensor="1,1")
+
+        digests.save()
+
+        perfMsgs = []
+        if perfDbPath:
+            mode = "inprocess" if inProcess else "stages"
+            if cache is not None:
+                mode += "+stageCache"
+            perfMsgs = self._perfGate(perfDbPath, ccd, mode, benchmark,
+                    outButler, visit=85408556, raft="2,3", sensor="1,1")
 
         # Deferred failure!
-        self.assertFalse(psfDiffers)
         for datasetType,msg in results:
             self.assert_(msg is None, msg)
+        if os.environ.get("ENDTOEND_PERF_GATE", "warn") == "fail":
+            self.assertEqual(perfMsgs, [], "\n".join(perfMsgs))
+        self.passed = True
+
+    def _perfGate(self, perfDbPath, ccd, mode, benchmark, outButler,
+            **dataId):
+        """Record the benchmark and output sizes in the performance history
+        and return messages for metrics that regressed against earlier runs
+        in the same execution mode"""
+        metrics = []
+        for stage in benchmark.stages:
+            for metric in ("wallTime", "cpuTime", "peakRss",
+                    "readBytes", "writeBytes"):
+                metrics.append((stage["name"], metric, stage[metric]))
+        for datasetType in ("icSrc", "src", "calexp", "psf"):
+            metrics.append(("output", datasetType, os.path.getsize(
+                _datasetPath(outButler, datasetType, dataId))))
+
+        history = PerfHistory(perfDbPath)
+        runId = history.record(ccd, mode, metrics)
+        msgs = history.regressions(runId,
+                window=int(os.environ.get("ENDTOEND_PERF_WINDOW", 10)),
+                sigma=float(os.environ.get("ENDTOEND_PERF_SIGMA", 3.0)),
+                slack=float(os.environ.get("ENDTOEND_PERF_SLACK", 0.05)))
+        for msg in msgs:
+            print "warning: performance regression:", msg
+        return msgs
+
+    def testSweep(self):
+        """Run and check every CCD listed in ENDTOEND_SWEEP in parallel"""
+
+        spec = os.environ.get("ENDTOEND_SWEEP")
+        if not spec:
+            print "ENDTOEND_SWEEP not set; skipping multi-CCD sweep"
+            return
+
+        self._setupAstrometryNetData()
+
+        afwdataDir = lsst.utils.getPackageDir("afwdata")
+        inputRoot = os.path.join(afwdataDir, "ImSim")
+        self.workspace = Workspace(workspaceBase, "sweep")
+        sweepRoot = self.workspace.path
+        ccds = _sweepCcds(inputRoot, spec)
+
+        pool = multiprocessing.Pool(sweepProcesses)
+        try:
+            sweep = pool.map(sweepCcd, [(inputRoot, sweepRoot) + tuple(ccd)
+                for ccd in ccds], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        print "%-20s %-6s %10s %10s" % ("CCD", "status", "run (s)",
+                "cmp (s)")
+        for r in sweep:
+            print "%-20s %-6s %10.1f %10.1f" % (r["ccd"], r["status"],
+                    r["runTime"], r["compareTime"])
+            for msg in r["messages"]:
+                print "    " + msg.split("\n")[0]
+        reportPath = os.environ.get("ENDTOEND_SWEEP_REPORT")
+        if reportPath:
+            with open(reportPath, "w") as f:
+                json.dump(sweep, f, indent=1)
+
+        # Keep the outputs of failing CCDs for inspection
+        if os.listdir(sweepRoot):
+            print "Failing CCD outputs kept in", sweepRoot
+            self.workspace = None
+
+        # Deferred failure!
+        for r in sweep:
+            self.assert_(r["status"] in ("pass", "noref"),
+                    "%s: %s" % (r["ccd"], "; ".join(r["messages"])))
+        self.passed = True
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -0,0 +1,282 @@
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Comparison of end-to-end test outputs with the reference outputs that
+needs only numpy, so that it can be tested without afw or afwdata.  It is
+used by endToEnd.py and checked by comparators.py."""
+
+import itertools
+import math
+
+import numpy
+
+# Plane name and tolerance (None for a bitwise comparison), in the order
+# the planes appear in each tile
+calexpPlanes = (("img", 1.0e-8), ("var", 1.0e-8), ("mask", None))
+
+def cmpFloat(v1, v2, tol=1e-10):
+    if v2 == 0.0:
+        return abs(v1) <= tol
+    else:
+        return abs(v1 - v2) / v2 <= tol
+
+def cmpFloatArray(v1, v2, tol=1e-10, nanEqual=True):
+    """Vectorized version of cmpFloat; returns a boolean array that is
+    True wherever the values agree, or (if nanEqual) are both NaN"""
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ok = numpy.where(v2 == 0.0, numpy.abs(v1) <= tol,
+                numpy.abs(v1 - v2) / v2 <= tol)
+    if nanEqual:
+        ok |= numpy.isnan(v1) & numpy.isnan(v2)
+    return ok
+
+def pixelCompare(tiles1, tiles2, fullReport=False, report=None):
+    """Compare two streams of (image, variance, mask) row bands.
+
+    Without fullReport, the result is the message of the first plane, in
+    image, variance, mask order, with an out-of-tolerance pixel anywhere
+    in the exposure: its maximum (or else minimum) difference, or for the
+    mask the sum of the xor, over the whole exposure.  Once a plane has a
+    bad pixel the planes after it cannot change the message, so they are
+    no longer compared.  With fullReport, the extreme differences and the
+    count of bad pixels in every plane are reported.
+
+    If report is a dict, it is filled with per-plane statistics over the
+    whole exposure: max, min and RMS difference and the count and fraction
+    of out-of-tolerance pixels, or for the mask the number of pixels
+    disagreeing in each bit.  A report implies fullReport.
+    """
+    if report is not None:
+        fullReport = True
+    stats = [dict(max=0.0, min=0.0, sum=0, nBad=0, n=0, nFinite=0,
+        sumSq=0.0, bits=dict()) for plane in calexpPlanes]
+    nPlanes = len(calexpPlanes)
+    for bands1, bands2 in itertools.izip(tiles1, tiles2):
+        planes = zip(calexpPlanes, stats, bands1, bands2)[:nPlanes]
+        for i, ((name, tol), st, p1, p2) in enumerate(planes):
+            st["n"] += p1.size
+            if tol is None:
+                diff = numpy.bitwise_xor(p1, p2)
+                nBad = numpy.count_nonzero(diff)
+                if nBad == 0:
+                    continue
+                st["max"] = max(st["max"], diff.max())
+                st["sum"] += diff.sum(dtype=numpy.int64)
+                st["nBad"] += nBad
+                if not fullReport:
+                    nPlanes = min(nPlanes, i + 1)
+                if report is not None:
+                    diff = diff.astype(numpy.int64)
+                    for bit in xrange(8 * p1.dtype.itemsize):
+                        n = numpy.count_nonzero((diff >> bit) & 1)
+                        if n > 0:
+                            st["bits"][bit] = st["bits"].get(bit, 0) + n
+                continue
+
+            diff = numpy.subtract(p1, p2)
+            with numpy.errstate(invalid="ignore"):
+                nBad = numpy.count_nonzero((diff > tol) | (diff < -tol))
+            if report is not None:
+                finite = diff[numpy.isfinite(diff)].astype(numpy.float64)
+                st["nFinite"] += finite.size
+                st["sumSq"] += numpy.square(finite).sum()
+                if finite.size > 0:
+                    st["max"] = max(st["max"], finite.max())
+                    st["min"] = min(st["min"], finite.min())
+            if nBad == 0:
+                continue
+            st["max"] = max(st["max"], numpy.nanmax(diff))
+            st["min"] = min(st["min"], numpy.nanmin(diff))
+            st["nBad"] += nBad
+            if not fullReport:
+                nPlanes = min(nPlanes, i + 1)
+
+    if not fullReport:
+        for (name, tol), st in zip(calexpPlanes, stats):
+            if st["nBad"] == 0:
+                continue
+            if tol is None:
+                return "calexp %s sum = %d" % (name, st["sum"])
+            if st["max"] > tol:
+                return "calexp %s max diff = %g" % (name, st["max"])
+            return "calexp %s min diff = %g" % (name, st["min"])
+        return None
+
+    msgs = []
+    for (name, tol), st in zip(calexpPlanes, stats):
+        if report is not None:
+            entry = dict(pixels=st["n"], badPixels=st["nBad"],
+                    badFraction=st["nBad"] / float(max(st["n"], 1)))
+            if tol is None:
+                entry["bitDisagreements"] = dict((str(bit), n)
+                        for bit, n in sorted(st["bits"].iteritems()))
+            else:
+                entry.update(maxDiff=float(st["max"]),
+                        minDiff=float(st["min"]),
+                        rmsDiff=math.sqrt(st["sumSq"] /
+                            max(st["nFinite"], 1)))
+            report[name] = entry
+        if st["nBad"] == 0:
+            continue
+        if tol is None:
+            msgs.append("calexp %s: %d pixels differ, max xor %d" %
+                    (name, st["nBad"], st["max"]))
+        else:
+            msgs.append("calexp %s: %d pixels differ, "
+                    "max diff = %g, min diff = %g" %
+                    (name, st["nBad"], st["max"], st["min"]))
+    if len(msgs) == 0:
+        return None
+    return "\n".join(msgs)
+
+def sourceColumns(sources, plan):
+    """Pull every field of a source vector into numpy arrays in one pass.
+
+    Returns a list of (values, nulls) pairs parallel to the field plan;
+    Angles are converted to degrees and nulls is None for fields without a
+    null flag.
+    """
+    columns = []
+    for getField, num, tol, isAngle in plan:
+        if isAngle:
+            values = [getattr(s, getField)().asDegrees() for s in sources]
+        else:
+            values = [getattr(s, getField)() for s in sources]
+        if num is None:
+            nulls = None
+        else:
+            nulls = numpy.array([s.isNull(num) for s in sources], dtype=bool)
+        columns.append((numpy.array(values, dtype=numpy.float64), nulls))
+    return columns
+
+def _worstOffenders(v1, v2, n1, n2, bad, count=5):
+    """Return the count bad sources with the largest relative differences;
+    null mismatches and NaNs rank first"""
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rel = numpy.abs(v1[bad] - v2[bad]) / numpy.abs(v2[bad])
+    rel[~numpy.isfinite(rel)] = numpy.inf
+    if n1 is not None:
+        rel[n1[bad] != n2[bad]] = numpy.inf
+    worst = []
+    for j in numpy.argsort(-rel, kind="mergesort")[:count]:
+        i = bad[j]
+        worst.append(dict(index=int(i), test=float(v1[i]), ref=float(v2[i]),
+            relDiff=(float(rel[j]) if numpy.isfinite(rel[j]) else None),
+            testNull=(n1 is not None and bool(n1[i])),
+            refNull=(n2 is not None and bool(n2[i]))))
+    return worst
+
+def sourcesCompare(t, src1, src2, plan, report=None):
+    """Compare two equally long, non-empty source vectors field by field,
+    following a plan of (getter name, null field number or None,
+    tolerance, isAngle) tuples.
+
+    Returns the message for the mismatch a source-by-source walk would
+    have hit first, or None.  If report is a dict, its "fields" entry is
+    filled with the mismatch count and worst offenders of each field.
+    """
+    cols1 = sourceColumns(src1, plan)
+    cols2 = sourceColumns(src2, plan)
+
+    # Report the mismatch a source-by-source walk would have hit first:
+    # lowest source index, then earliest field
+    first = None
+    for (getField, num, tol, isAngle), (v1, n1), (v2, n2) in \
+            zip(plan, cols1, cols2):
+        # Angles were never NaN-equal: only floats went through the
+        # str(v) == "nan" check
+        ok = cmpFloatArray(v1, v2, tol, nanEqual=not isAngle)
+        if n1 is None:
+            nullBad = numpy.zeros(len(v1), dtype=bool)
+        else:
+            nullBad = (n1 != n2)
+            ok |= n1
+        bad = numpy.flatnonzero(nullBad | ~ok)
+        if report is not None and len(bad) > 0:
+            report["fields"][getField] = dict(mismatches=len(bad),
+                    worst=_worstOffenders(v1, v2, n1, n2, bad))
+        if len(bad) == 0 or (first is not None and bad[0] >= first[0]):
+            continue
+        i = bad[0]
+        if nullBad[i]:
+            msg = "%s %s null: test %s, ref %s" % (t, getField,
+                    str(n1[i]), str(n2[i]))
+        else:
+            msg = "%s %s: test %g, ref %g" % (t, getField, v1[i], v2[i])
+        first = (i, msg)
+    if first is not None:
+        return first[1]
+    return None
+
+def sdqaAmpTableCompare(ratings1, ratings2):
+    """Compare the ratings of many amplifiers, as read by
+    loadSdqaAmpRatings, in one vectorized pass.
+
+    Ratings are matched by position, as in sdqaCompare.  Returns a dict
+    mapping (snap, channel) to None or the first mismatch for that
+    amplifier.
+    """
+    msgs = dict()
+    amps = []
+    for amp in sorted(set(ratings1.keys()) | set(ratings2.keys())):
+        prefix = "sdqaAmp snap %s channel %s " % amp
+        msgs[amp] = None
+        if amp not in ratings2:
+            msgs[amp] = prefix + "missing from ref"
+        elif amp not in ratings1:
+            msgs[amp] = prefix + "missing from test"
+        elif len(ratings1[amp]) != len(ratings2[amp]):
+            msgs[amp] = prefix + "lengths: test %d, ref %d" % (
+                    len(ratings1[amp]), len(ratings2[amp]))
+        else:
+            amps.append(amp)
+
+    rows1 = [row for amp in amps for row in ratings1[amp]]
+    rows2 = [row for amp in amps for row in ratings2[amp]]
+    if len(rows1) == 0:
+        return msgs
+    owners = [amp for amp in amps for row in ratings1[amp]]
+    r1 = numpy.array([row[1:] for row in rows1], dtype=numpy.float64)
+    r2 = numpy.array([row[1:] for row in rows2], dtype=numpy.float64)
+    nameBad = numpy.array([row1[0] != row2[0]
+        for row1, row2 in zip(rows1, rows2)])
+    valueBad = ~cmpFloatArray(r1[:, 0], r2[:, 0], nanEqual=False)
+    errBad = ~cmpFloatArray(r1[:, 1], r2[:, 1], nanEqual=False)
+    scopeBad = r1[:, 2] != r2[:, 2]
+    # Rows are in rating order within each amplifier, so the first bad
+    # row seen for an amplifier is the one sdqaCompare would report
+    for i in numpy.flatnonzero(nameBad | valueBad | errBad | scopeBad):
+        amp = owners[i]
+        if msgs[amp] is not None:
+            continue
+        name1, value1, err1, scope1 = rows1[i]
+        name2, value2, err2, scope2 = rows2[i]
+        if nameBad[i]:
+            msg = "names: test %s, ref %s" % (name1, name2)
+        elif valueBad[i]:
+            msg = "%s values: test %g, ref %g" % (name1, value1, value2)
+        elif errBad[i]:
+            msg = "%s errors: test %g, ref %g" % (name1, err1, err2)
+        else:
+            msg = "%s scope: test %d, ref %d" % (name1, scope1, scope2)
+        msgs[amp] = "sdqaAmp snap %s channel %s " % amp + msg
+    return msgs
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Check the single-pass LogAnalysis of bin/drpRun.py and bin/drpRunSdss.py
+against the SQL queries it replaced, run on a sqlite Logs table (sqlite's
+LIKE is case-insensitive and lets % match newlines, as MySQL's is by
+default)."""
+
+from __future__ import with_statement
+
+import unittest
+import lsst.utils.tests as utilsTests
+
+import imp
+import os
+import random
+import shutil
+try:
+    import sqlite3
+except ImportError:
+    # try external pysqlite package; deprecated
+    import sqlite as sqlite3
+import tempfile
+
+binDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.path.pardir, "bin")
+drpRun = imp.load_source("drpRun", os.path.join(binDir, "drpRun.py"))
+drpRunSdss = imp.load_source("drpRunSdss",
+        os.path.join(binDir, "drpRunSdss.py"))
+
+_commonMessages = [
+        "Ending write to BoostStorage /x/output/src/v1/src.boost",
+        "ending write to fitsstorage /x/output/calexp/v1.fits",
+        "Ending write to FitsStorage /x/output/src/v1.fits",
+        "Fail", "fail", "FAIL", "Failed to converge", "prefail suffix",
+        "Some error here\nTraceback (most recent call last):\n"
+        "  File \"a.py\", line 3, in foo\n    boom()\nRuntimeError: boom\n\n",
+        "WARNING: deprecated", "Exception\nwithout a frame",
+        "errorFlagged thing", "failSerialName=a", "FAILPARALLELNAME=b",
+        "stage failureStage set", "Distortion fitter failed to improve fit",
+        "no magnitude error column", "Skipping process due to error",
+        "skipping process due to error later", "hello", None]
+
+_lsstMessages = _commonMessages + [
+        "Processing job: raft=0 sensor=0 type=calexp visit=0",
+        "processing JOB: raft=0 sensor=0 type=calexp VISIT=0",
+        "Processing job: visit=0 and more",
+        "Processing job: raft=1,2 sensor=0,1 type=calexp visit=85408556",
+        "Processing job: raft=2,3 sensor=1,1 type=calexp visit=85408557"]
+
+_sdssMessages = _commonMessages + [
+        "Processing job: camcol=0 field=0 filter=0 run=0 type=calexp",
+        "Processing job: camcol=1 field=100 filter=r run=1033 type=calexp",
+        "Processing job: camcol=2 field=101 filter=g run=1033 type=calexp",
+        "processing job: something else"]
+
+def _lsstJob(match):
+    return "Visit %s Raft %s Sensor %s" % (match.group("visit"),
+            match.group("raft"), match.group("sensor"))
+
+def _lsstCcd(match):
+    return dict(visit=int(match.group("visit")), raft=match.group("raft"),
+            sensor=match.group("sensor"))
+
+def _sdssJob(match):
+    return "Band %s Run %s Camcol %s Frame %s" % (match.group("filter"),
+            match.group("run"), match.group("camcol"), match.group("field"))
+
+def _sdssCcd(match):
+    return dict(run=int(match.group("run")), filter=match.group("filter"),
+            camcol=int(match.group("camcol")), field=int(match.group("field")))
+
+def makeLogs(messages, nRows, seed):
+    """Return a sqlite connection holding a random Logs table"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""CREATE TABLE Logs (id INTEGER PRIMARY KEY,
+        TIMESTAMP INTEGER, timereceived TEXT, workerid TEXT,
+        stagename TEXT, COMMENT TEXT)""")
+    timestamp = 1300000000 * 10**9
+    for i in xrange(nRows):
+        timestamp += rng.randint(0, 10**12)
+        worker = rng.choice(["worker%d" % w for w in xrange(6)] + [None])
+        conn.execute("INSERT INTO Logs VALUES (?, ?, ?, ?, ?, ?)",
+                (i + 1, timestamp, "received %d" % (i,), worker,
+                    rng.choice(["isr", "sfm"]), rng.choice(messages)))
+    return conn
+
+def sqlAnalysis(conn, module, shutdownPattern, job, ccd, inProgress):
+    """The analysis as analyzeLogs did it before LogAnalysis, in SQL;
+    returns the result text and the CCD durations"""
+    jobStartRegex = module.LogAnalysis.jobStartRegex
+    row = conn.execute("""SELECT TIMESTAMP, timereceived FROM Logs
+        WHERE id = (SELECT MIN(id) FROM Logs)""").fetchone()
+    if row is None:
+        if inProgress:
+            return "No log entries yet\n", dict()
+        else:
+            return "*** No log entries written\n", dict()
+    startTime, start = row
+    result = "First orca log entry: %s\n" % (start,)
+    stopTime, stop = conn.execute("""SELECT TIMESTAMP, timereceived FROM Logs
+        WHERE id = (SELECT MAX(id) FROM Logs)""").fetchone()
+    result += "Last orca log entry: %s\n" % (stop,)
+    elapsed = long(stopTime) - long(startTime)
+    elapsedHr = elapsed / 3600 / 1000 / 1000 / 1000
+    elapsed -= elapsedHr * 3600 * 1000 * 1000 * 1000
+    elapsedMin = elapsed / 60 / 1000 / 1000 / 1000
+    elapsed -= elapsedMin * 60 * 1000 * 1000 * 1000
+    elapsedSec = elapsed / 1.0e9
+    result += "Orca elapsed time: %d:%02d:%06.3f\n" % (elapsedHr,
+            elapsedMin, elapsedSec)
+
+    nPipelines = conn.execute("""
+        SELECT COUNT(DISTINCT workerid) FROM
+            (SELECT workerid FROM Logs LIMIT 10000) AS sample""").fetchone()[0]
+    result += "%d pipelines used\n" % (nPipelines,)
+
+    nShutdown = 0
+    for d, n in conn.execute("""
+            SELECT CASE gid
+                WHEN 1 THEN 'pipeline shutdowns seen'
+                WHEN 2 THEN 'CCDs attempted'
+                WHEN 3 THEN 'src writes'
+                WHEN 4 THEN 'calexp writes'
+            END AS descr, COUNT(*) FROM (
+                SELECT CASE
+                    WHEN COMMENT LIKE 'Processing job:' || ? THEN 1
+                    WHEN COMMENT LIKE 'Processing job:%'
+                        AND COMMENT NOT LIKE ? THEN 2
+                    WHEN COMMENT LIKE 'Ending write to BoostStorage%/src%'
+                    THEN 3
+                    WHEN COMMENT LIKE 'Ending write to FitsStorage%/calexp%'
+                    THEN 4
+                    ELSE 0
+                END AS gid
+                FROM Logs
+            ) AS stats WHERE gid > 0 GROUP BY gid""",
+            (shutdownPattern, shutdownPattern)).fetchall():
+        result += "%d %s\n" % (n, d)
+        if d == 'pipeline shutdowns seen':
+            nShutdown = n
+    if nShutdown != nPipelines:
+        if not inProgress:
+            if nShutdown == 0:
+                result += "\n*** No pipelines were shut down properly\n"
+            else:
+                result += "\n*** Shutdowns do not match pipelines\n"
+        for worker, msg in conn.execute("""
+                SELECT workerid, COMMENT
+                FROM Logs JOIN
+                (SELECT MAX(id) AS last FROM Logs GROUP BY workerid) AS a
+                ON (Logs.id = a.last) ORDER BY Logs.id""").fetchall():
+            if inProgress:
+                result += "Pipeline %s last status: %s\n" % (worker, msg)
+            else:
+                result += "Pipeline %s ended with: %s\n" % (worker, msg)
+
+    result += "%s failures seen\n" % conn.execute("""
+        SELECT COUNT(*) FROM Logs
+        WHERE (
+            COMMENT LIKE '%rror%'
+            OR COMMENT LIKE '%xception%'
+            OR COMMENT LIKE '%arning%'
+            OR COMMENT LIKE 'Fail'
+            OR COMMENT LIKE 'fail'
+        )
+        AND COMMENT NOT LIKE '%failureStage%'
+        AND COMMENT NOT LIKE '%failure stage%'
+        AND COMMENT NOT LIKE 'failSerialName%'
+        AND COMMENT NOT LIKE 'failParallelName%'
+        AND COMMENT NOT LIKE 'Distortion fitter failed to improve%'
+        AND COMMENT NOT LIKE '%magnitude error column%'
+        AND COMMENT NOT LIKE '%errorFlagged%'
+        AND COMMENT NOT LIKE 'Skipping process due to error'""").fetchone()
+
+    cursor = conn.execute("""
+        SELECT * FROM Logs
+        WHERE COMMENT LIKE 'Processing job:%'
+            OR (
+                (
+                    COMMENT LIKE '%rror%'
+                    OR COMMENT LIKE '%xception%'
+                    OR COMMENT LIKE '%arning%'
+                    OR COMMENT LIKE '%Fail%'
+                    OR COMMENT LIKE '%fail%'
+                )
+                AND COMMENT NOT LIKE '%failureStage%'
+                AND COMMENT NOT LIKE '%failure stage%'
+                AND COMMENT NOT LIKE 'failSerialName%'
+                AND COMMENT NOT LIKE 'failParallelName%'
+                AND COMMENT NOT LIKE 'Distortion fitter failed to improve%'
+                AND COMMENT NOT LIKE '%magnitude error column%'
+                AND COMMENT NOT LIKE '%errorFlagged%'
+                AND COMMENT NOT LIKE 'Skipping process due to error'
+            )
+        ORDER BY id""")
+    names = [c[0] for c in cursor.description]
+    jobs = dict()
+    jobStarts = dict()
+    durations = dict()
+    for d in [dict(zip(names, row)) for row in cursor.fetchall()]:
+        if d['COMMENT'].startswith('Processing job:') and \
+                jobStarts.has_key(d['workerid']):
+            id, start = jobStarts.pop(d['workerid'])
+            durations[id] = (long(d['TIMESTAMP']) - start) / 1.0e9
+        match = jobStartRegex.search(d['COMMENT'])
+        if match:
+            id = module.RunConfiguration.ccdIdPattern % ccd(match)
+            jobStarts[d['workerid']] = (id, long(d['TIMESTAMP']))
+            jobs[d['workerid']] = job(match)
+        elif not d['COMMENT'].startswith('Processing job:'):
+            result += "\n*** Error in %s in stage %s on %s:\n" % (
+                    jobs.get(d['workerid'], "unknown"), d['stagename'],
+                    d['workerid'])
+            lines = d['COMMENT'].split('\n')
+            i = len(lines) - 1
+            message = lines[i].strip()
+            while i > 0 and message == "":
+                i -= 1
+                message = lines[i].strip()
+            while i > 0 and lines[i].find(" in ") == -1:
+                i -= 1
+                message = lines[i].strip() + "\n" + message
+            result += message + "\n"
+    return result, durations
+
+def rows(conn, after=0):
+    cursor = conn.execute("""
+        SELECT id, TIMESTAMP, timereceived, workerid, stagename, COMMENT
+        FROM Logs WHERE id > ? ORDER BY id""", (after,))
+    names = [c[0] for c in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+class LogAnalysisTestCase(unittest.TestCase):
+    """Compare LogAnalysis with the SQL it replaced"""
+
+    scripts = [(drpRun, _lsstMessages, "% visit=0", _lsstJob, _lsstCcd),
+            (drpRunSdss, _sdssMessages, "% filter=0%", _sdssJob, _sdssCcd)]
+
+    def testLikeRegex(self):
+        for module in (drpRun, drpRunSdss):
+            regex = module._likeRegex("Processing job:% visit=0")
+            self.assert_(regex.search("PROCESSING JOB: raft=0 visit=0"))
+            self.assert_(regex.search("Processing job:\n visit=0"))
+            self.assert_(not regex.search("Processing job: visit=01"))
+            self.assert_(not regex.search(" Processing job: visit=0"))
+            regex = module._likeRegex("Fail", "%rror%")
+            self.assert_(regex.search("fail"))
+            self.assert_(not regex.search("failed"))
+            self.assert_(regex.search("an ERROR\nhere"))
+            self.assert_(module._likeRegex("a_c").search("abc"))
+            self.assert_(not module._likeRegex("a_c").search("ac"))
+
+    def testEquivalence(self):
+        for module, messages, shutdownPattern, job, ccd in self.scripts:
+            for seed, nRows in ((1, 0), (2, 1), (3, 50), (4, 500)):
+                conn = makeLogs(messages, nRows, seed)
+                analysis = module.LogAnalysis()
+                for d in rows(conn):
+                    analysis.consume(d)
+                for inProgress in (True, False):
+                    result, durations = sqlAnalysis(conn, module,
+                            shutdownPattern, job, ccd, inProgress)
+                    self.assertEqual(analysis.format(inProgress), result)
+                    self.assertEqual(analysis.durations, durations)
+
+    def testIncremental(self):
+        """Resuming from a saved analysis gives the same result as one
+        pass, even after a save that appended excerpts but never wrote its
+        state"""
+        for module, messages, shutdownPattern, job, ccd in self.scripts:
+            conn = makeLogs(messages, 300, 5)
+            directory = tempfile.mkdtemp()
+            try:
+                statePath = os.path.join(directory, "logAnalysis.json")
+                excerptPath = os.path.join(directory,
+                        "logAnalysisExcerpts.json")
+                analysis = module._loadLogAnalysis(statePath, excerptPath,
+                        "db")
+                self.assertEqual(analysis.lastId, 0)
+                for end in (0, 1, 100, 200, 300):
+                    analysis = module._loadLogAnalysis(statePath,
+                            excerptPath, "db")
+                    for d in rows(conn, analysis.lastId):
+                        if d['id'] > end:
+                            break
+                        analysis.consume(d)
+                    module._saveLogAnalysis(analysis, statePath, excerptPath,
+                            "db")
+                    with open(excerptPath, "a") as f:
+                        f.write('"lost excerpt"\n')
+                analysis = module._loadLogAnalysis(statePath, excerptPath,
+                        "db")
+                self.assertEqual(analysis.lastId, 300)
+                for inProgress in (True, False):
+                    result, durations = sqlAnalysis(conn, module,
+                            shutdownPattern, job, ccd, inProgress)
+                    self.assertEqual(analysis.format(inProgress), result)
+                    self.assertEqual(analysis.durations, durations)
+                # Another run's analysis is not resumed
+                analysis = module._loadLogAnalysis(statePath, excerptPath,
+                        "otherDb")
+                self.assertEqual(analysis.lastId, 0)
+            finally:
+                shutil.rmtree(directory)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(LogAnalysisTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)